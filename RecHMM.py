@@ -1,51 +1,768 @@
 #!/usr/bin/env python
-import numpy as np, pandas as pd, sys, os, copy, argparse, re, gzip
+import numpy as np, sys, os, copy, argparse, gzip
 from numba import jit
 from time import time
-import functools, datetime
+import functools, datetime, tempfile, weakref, pickle, hashlib
+from collections import OrderedDict
 from multiprocessing import Pool
 
 
-def _iter_branch_measure(obj, arg) :
-    return obj.iter_branch_measure(arg)
-
-
-def _iter_viterbi(obj, arg) :
-    return obj.viterbi(arg)    
-
-
-@jit(nopython=True, fastmath=True)
-def update_distant_transition(transition, emission, dist_transition, dist_transition_adj) :
-    interval = dist_transition.shape[0]
+def _iter_block_measure(task) :
+    (fname, key), args = task
+    hmm = _engine_hmm(fname)
+    return key, [ hmm.iter_block_measure(arg) for arg in args ]
+
+
+def _iter_block_viterbi(task) :
+    (fname, key), args = task
+    hmm = _engine_hmm(fname)
+    return key, [ hmm.block_viterbi(arg) for arg in args ]
+
+
+def _branch_slice(params, brId) :
+    # a task carries only the rows of its branch in the parameter tensors
+    return params['pi'][brId], params['a'][brId], params['b'][brId]
+
+
+_engine_hmms = {}
+
+def _engine_hmm(fname) :
+    # the HMM of an engine, read once per worker from the file the engine pickled it to
+    if fname not in _engine_hmms :
+        _engine_hmms.clear()
+        with open(fname, 'rb') as fin :
+            _engine_hmms[fname] = pickle.load(fin)
+    return _engine_hmms[fname]
+
+
+class BlockEngine(object) :
+    # a Pool whose workers load the HMM and attach to its observation store once, on their
+    # first task. Workers are not tied to one HMM, so an outside Pool can serve several
+    # engines in turn; otherwise the engine starts its own at the first batch. Work goes out as (branch, block) units, packed per branch into tasks of
+    # similar numbers of observations. Tasks are sent largest first, one at a time, so
+    # idle workers pick up the tail; results are merged back per branch in block order.
+    # Predictions instead stream branch by branch. The E-step runs all blocks of a task in one kernel call.
+    def __init__(self, hmm, n_proc, pool=None) :
+        self.units = [ (brId, blkId) for brId, observation in enumerate(hmm.observations) for blkId in range(len(observation)) ]
+        self.intervals = [ np.max([np.max(o.gap) for o in observation] + [50]) for observation in hmm.observations ]
+        sizes = [ len(obs) for observation in hmm.observations for obs in observation ]
+        target = np.sum(sizes) / (n_proc * 16.)
+
+        tasks, costs = [], []
+        for i, (brId, blkId) in enumerate(self.units) :
+            if len(tasks) == 0 or self.units[tasks[-1][0]][0] != brId or costs[-1] + sizes[i] > target :
+                tasks.append([])
+                costs.append(0)
+            tasks[-1].append(i)
+            costs[-1] += sizes[i]
+        self.tasks = [ tasks[i] for i in np.argsort(-np.array(costs), kind='stable') ]
+        self.branches = [ self.units[task[0]][0] for task in self.tasks ]
+        fd, self.fname = tempfile.mkstemp(prefix='redHMM.', suffix='.hmm.pkl')
+        with os.fdopen(fd, 'wb') as fout :
+            pickle.dump(hmm, fout)
+        weakref.finalize(self, _remove_file, self.fname, os.getpid())
+        self.n_proc, self.pool, self.own_pool = n_proc, pool, pool is None
+
+    def _run(self, func, batch) :
+        # batch holds, per model, the list of arguments of every task; the tasks of all models
+        # are interleaved so that a single pass keeps every worker busy
+        if self.pool is None :
+            self.pool = Pool(self.n_proc)
+        results = [ [None for task in self.tasks] for args in batch ]
+        tasks = [ ((self.fname, (mId, tId)), args[tId]) for tId in range(len(self.tasks)) for mId, args in enumerate(batch) ]
+        for (mId, tId), res in self.pool.imap_unordered(func, tasks) :
+            results[mId][tId] = res
+        outputs = []
+        for result in results :
+            outputs.append([[] for interval in self.intervals])
+            for tId in np.argsort([ task[0] for task in self.tasks ]) :
+                outputs[-1][self.branches[tId]].extend(result[tId])
+        return outputs
+
+    def _stream(self, func, args) :
+        # the results of a single model, branch by branch, each as soon as the tasks of the branch and
+        # of all branches before it are back. Tasks go out in branch order through an ordered imap
+        if self.pool is None :
+            self.pool = Pool(self.n_proc)
+        tasks = [ ((self.fname, tId), args[tId]) for tId in np.argsort([ task[0] for task in self.tasks ]) ]
+        brId, results = None, []
+        for tId, res in self.pool.imap(func, tasks) :
+            if self.branches[tId] != brId :
+                if brId is not None :
+                    yield brId, results
+                brId, results = self.branches[tId], []
+            results.extend(res)
+        if brId is not None :
+            yield brId, results
+
+    def _measure_args(self, params, gammaOnly, skip=()) :
+        # branches in <skip> are left out
+        return [ [ (brId, [ self.units[i][1] for i in task ], _branch_slice(params, brId), gammaOnly, self.intervals[brId]) ] if brId not in skip else [] \
+                    for brId, task in zip(self.branches, self.tasks) ]
+
+    def measure(self, model_params, skip=()) :
+        return self._run(_iter_block_measure, [ self._measure_args(params, False, skip) for params in model_params ])
+
+    def marginal(self, params) :
+        return self._stream(_iter_block_measure, self._measure_args(params, True))
+
+    def viterbi(self, params) :
+        return self._stream(_iter_block_viterbi, [ [ self.units[i] + (_branch_slice(params, brId), ) for i in task ] for brId, task in zip(self.branches, self.tasks) ])
+
+    def close(self) :
+        if self.own_pool and self.pool is not None :
+            self.pool.terminate()
+
+
+_attached_stores = {}
+
+def _remove_file(fname, owner) :
+    if os.getpid() == owner and os.path.exists(fname) :
+        os.remove(fname)
+
+
+def _replace_file(fname, write) :
+    # <write> fills a file next to <fname>, which is then renamed over it
+    with open(fname + '.tmp', 'wb') as fout :
+        write(fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(fname + '.tmp', fname)
+
+
+def _read_npz(fname) :
+    # the arrays of an npz file. Those stored uncompressed, as np.savez writes them, are mapped
+    # from the file copy-on-write rather than read
+    import zipfile, struct
+    arrays = {}
+    with zipfile.ZipFile(fname) as zf, open(fname, 'rb') as fin :
+        for info in zf.infolist() :
+            if info.compress_type == zipfile.ZIP_STORED :
+                fin.seek(info.header_offset + 26)
+                n_name, n_extra = struct.unpack('<HH', fin.read(4))
+                fin.seek(info.header_offset + 30 + n_name + n_extra)
+                version = np.lib.format.read_magic(fin)
+                shape, fortran, dtype = (np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0)(fin)
+                if len(shape) and np.prod(shape) > 0 and not dtype.hasobject :
+                    arrays[info.filename[:-4]] = np.memmap(fname, dtype=dtype, mode='c', offset=fin.tell(), shape=shape, order='F' if fortran else 'C')
+                    continue
+            with zf.open(info) as f :
+                arrays[info.filename[:-4]] = np.lib.format.read_array(f)
+    return arrays
+
+
+_cache_version = 2
+
+class Observations(object) :
+    # the observations of one block as contiguous int32 columns. Branch and sequence are the
+    # same for every row and kept once; the kernels read state, gap and pos
+    __slots__ = ('seq', 'state', 'gap', 'pos', 'site')
+
+    def __init__(self, seq, columns) :
+        self.seq = seq
+        self.state, self.gap, self.pos, self.site = columns
+
+    def __len__(self) :
+        return self.state.size
+
+
+class ObservationStore(object) :
+    # all prepared observations in one memory-mapped (4, n) int32 array of state, gap, pos and
+    # site columns. Pickling the store only ships the file name and offsets, so Pool workers
+    # map the array instead of copying it.
+    # With a file name the array is kept, and its offsets plus info go to <fname>.idx.npz
+    def __init__(self, observations, fname=None, **info) :
+        self.blocks = np.cumsum([0] + [len(observation) for observation in observations])
+        self.bounds = np.cumsum([0] + [obs.shape[0] for observation in observations for obs in observation])
+        self.seqs = np.array([ obs[0, 1] for observation in observations for obs in observation ], dtype=np.int32)
+        data = np.ascontiguousarray(np.vstack([obs for observation in observations for obs in observation]).T[[3, 4, 5, 2]], dtype=np.int32)
+        if fname is None :
+            fd, self.fname = tempfile.mkstemp(prefix='redHMM.', suffix='.npy')
+            with os.fdopen(fd, 'wb') as fout :
+                np.save(fout, data)
+            weakref.finalize(self, _remove_file, self.fname, os.getpid())
+        else :
+            self.fname = fname
+            for name, save, kwargs in ((fname, np.save, dict(arr=data)), (fname + '.idx.npz', np.savez, dict(blocks=self.blocks, bounds=self.bounds, seqs=self.seqs, version=_cache_version, **info))) :
+                with open(name + '.tmp', 'wb') as fout :
+                    save(fout, **kwargs)
+                os.replace(name + '.tmp', name)
+
+    @classmethod
+    def load(cls, fname) :
+        with np.load(fname + '.idx.npz') as index :
+            if int(index['version']) != _cache_version or not os.path.isfile(fname) :
+                return None, {}
+            store = cls.__new__(cls)
+            store.fname, store.blocks, store.bounds, store.seqs = fname, index['blocks'], index['bounds'], index['seqs']
+            return store, { k:index[k] for k in index.files if k not in ('blocks', 'bounds', 'seqs', 'version') }
+
+    def __len__(self) :
+        return self.blocks.size - 1
+
+    def _attach(self) :
+        if self.fname not in _attached_stores :
+            _attached_stores.clear()
+            _attached_stores[self.fname] = np.load(self.fname, mmap_mode='r')
+        return _attached_stores[self.fname]
+
+    def __getitem__(self, brId) :
+        data = self._attach()
+        bounds = self.bounds[self.blocks[brId]:self.blocks[brId+1]+1]
+        seqs = self.seqs[self.blocks[brId]:self.blocks[brId+1]]
+        return [ Observations(seq, data[:, s:e]) for seq, s, e in zip(seqs, bounds[:-1], bounds[1:]) ]
+
+    def digest(self, brId) :
+        # fingerprint of the observations of a branch, to tell unchanged branches between runs
+        data, blocks = self._attach(), slice(self.blocks[brId], self.blocks[brId+1])
+        key = hashlib.sha1(np.ascontiguousarray(data[:, self.bounds[blocks.start]:self.bounds[blocks.stop]]).tobytes())
+        key.update(self.seqs[blocks].tobytes())
+        return key.hexdigest()[:20]
+
+    def segment(self, brId, first, last) :
+        # blocks first..last of a branch as one set of columns, and the offsets of the blocks in it
+        bounds = self.bounds[self.blocks[brId]+first:self.blocks[brId]+last+2]
+        return Observations(-1, self._attach()[:, bounds[0]:bounds[-1]]), bounds - bounds[0]
+
+    def __iter__(self) :
+        for brId in range(len(self)) :
+            yield self[brId]
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def update_distant_transition(transition, emission, interval) :
+    # scaled powers of the mutation-free step, kept only up to saturation. A longer gap
+    # reuses the last row, and its log-scale adjustment grows by slope per extra site
+    n_row = min(interval, 64)
+    dist_transition = np.zeros(shape=(n_row, transition.shape[0], transition.shape[1]))
+    dist_transition_adj = np.zeros(n_row)
     dist_transition[0] = transition
 
     saturate_id = 0
-    ss = 0.
+    ss, slope = 0., 0.
     for i in range(interval-1) :
         saturate_id = i
+        if i+1 >= n_row :
+            n_row = min(2*n_row, interval)
+            rows, adj = np.zeros(shape=(n_row, transition.shape[0], transition.shape[1])), np.zeros(n_row)
+            rows[:i+1], adj[:i+1] = dist_transition[:i+1], dist_transition_adj[:i+1]
+            dist_transition, dist_transition_adj = rows, adj
         t = np.dot(transition*emission[0], dist_transition[i])
         s = np.sum(t)/transition.shape[0]
         dist_transition[i+1] = t/s
         ss = ss + np.log(s)
         dist_transition_adj[i+1] = ss
+        slope = np.log(s)
         if np.sum(np.abs(dist_transition[i+1] - dist_transition[i])) <= 1e-10 :
-            dist_transition[i+2:] = dist_transition[i+1]
-            dist_transition_adj[i+1:] = dist_transition_adj[i+1] + np.arange(interval-i-1)*np.log(s)
-            break
-    return dist_transition, dist_transition_adj, saturate_id
+            return dist_transition[:i+2].copy(), dist_transition_adj[:i+2].copy(), saturate_id, slope
+    return dist_transition[:interval], dist_transition_adj[:interval], saturate_id, slope
+
+
+_transitions, _transitions_size = OrderedDict(), 256
+
+def _quantize(x) :
+    return (np.ascontiguousarray(x, dtype=np.float64).view(np.int64) >> 20 << 20).view(np.float64)
+
+def distant_transition(a, b, interval) :
+    # LRU of distance-transition tables, keyed on the rates with 32 mantissa bits, so that
+    # branches and models sharing the rates share the tables. The table is built from the
+    # quantized rates and is therefore the same whichever branch asks first. A table that
+    # saturated within the requested interval serves it as well as a freshly built one
+    off = ~np.eye(a.shape[0], dtype=bool)
+    qa, qm = _quantize(a[off]), _quantize(1 - b.T[0])
+    key = (a.shape[0], qa.tobytes(), qm.tobytes())
+    entry = _transitions.pop(key, None)
+    if entry is None or (entry[0] != interval and not entry[1][0].shape[0] < min(entry[0], interval+1)) :
+        transition = np.zeros(shape=a.shape)
+        transition[off] = qa
+        np.fill_diagonal(transition, 1-np.sum(transition, 1))
+        entry = (interval, update_distant_transition(transition, (1 - qm)[np.newaxis, :], interval))
+    _transitions[key] = entry
+    if len(_transitions) > _transitions_size :
+        _transitions.popitem(last=False)
+    return entry[1]
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def scaled_forward_backward(pi, dist_transition, dist_transition_adj, dist_transition_slope, bv, state, gap) :
+    n_obs, n_a, last = state.size, dist_transition.shape[1], dist_transition.shape[0]-1
+    alpha, beta = np.zeros(shape=(n_obs, n_a)), np.ones(shape=(n_obs, n_a))
+    r = np.zeros(n_a)
+
+    s = 0.
+    for j in range(n_a) :
+        x = 0.
+        for k in range(n_a) :
+            x += pi[k] * dist_transition[0, k, j]
+        r[j] = x * bv[state[0], j]
+        s += r[j]
+    alpha[0] = r/s
+    alpha_Pr = np.log(s)
+    for i in range(1, n_obs) :
+        t, o = min(gap[i]-1, last), state[i]
+        s = 0.
+        for j in range(n_a) :
+            x = 0.
+            for k in range(n_a) :
+                x += alpha[i-1, k] * dist_transition[t, k, j]
+            r[j] = x * bv[o, j]
+            s += r[j]
+        alpha[i] = r/s
+        adj = dist_transition_adj[t] + (gap[i]-1-t)*dist_transition_slope
+        alpha_Pr += np.log(s) + adj
+
+    for j in range(n_a) :
+        x = 0.
+        for k in range(n_a) :
+            x += pi[k] * dist_transition[0, j, k]
+        beta[n_obs-1, j] = x
+    for i in range(n_obs-1, 0, -1) :
+        t, o = min(gap[i]-1, last), state[i]
+        s = 0.
+        for j in range(n_a) :
+            x = 0.
+            for k in range(n_a) :
+                x += beta[i, k] * bv[o, k] * dist_transition[t, j, k]
+            r[j] = x
+            s += x
+        beta[i-1] = r/s
+    return alpha_Pr, alpha, beta
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def accumulate_expected_counts(transition, emission, state, gap, alpha, beta, dist_transition, saturate_id, gammaOnly) :
+    n_obs, n_a, n_b = state.size, emission.shape[0], emission.shape[1]
+    a2, b2 = np.zeros(shape=(n_a, n_a)), np.zeros(shape=(n_a, n_b))
+    gamma = alpha*beta
+    for i in range(n_obs) :
+        gamma[i] /= np.sum(gamma[i])
+        for j in range(n_a) :
+            b2[j, state[i]] += gamma[i, j]
+
+    na, nb, ng = np.zeros(n_a), np.zeros(n_a), np.zeros(n_a)
+    ne = np.zeros(shape=(n_a, n_a))
+    for j in range(n_a) :
+        for k in range(n_a) :
+            na[j] += alpha[0, k] * dist_transition[saturate_id, k, j]
+            nb[j] += beta[0, k] * dist_transition[saturate_id, j, k]
+        na[j] *= emission[j, 0]
+    ng[:] = na*nb/np.sum(na*nb)
+    for j in range(n_a) :
+        for k in range(n_a) :
+            ne[j, k] = na[j] * nb[k] * emission[k, 0] * transition[j, k]
+    ne /= np.sum(ne)
+
+    left, right, eo = np.zeros(n_a), np.zeros(n_a), np.zeros(n_a)
+    prev, prev_right = np.zeros(n_a), np.zeros(n_a)
+    t = np.zeros(shape=(n_a, n_a))
+    for i in range(1, n_obs) :
+        o = state[i]
+        d = gap[i] - 1
+        if d > 2*saturate_id :
+            for j in range(n_a) :
+                b2[j, 0] += (d - 2*saturate_id)*ng[j]
+                for k in range(n_a) :
+                    a2[j, k] += (d - 2*saturate_id)*ne[j, k]
+            d = 2 * saturate_id
+        for j in range(n_a) :
+            eo[j] = beta[i, j] * emission[j, o]
+
+        # position p carries the transition from site p-1 into site p of the gap;
+        # site -1 is the previous observation and site d is the current one
+        for p in range(d+1) :
+            if p == 0 :
+                left[:] = alpha[i-1]
+            elif p-1 < saturate_id :
+                for j in range(n_a) :
+                    x = 0.
+                    for k in range(n_a) :
+                        x += alpha[i-1, k] * dist_transition[p-1, k, j]
+                    left[j] = x * emission[j, 0]
+            else :
+                left[:] = na
+            if p == d :
+                right[:] = eo
+            else :
+                if d-1-p < saturate_id :
+                    for j in range(n_a) :
+                        x = 0.
+                        for k in range(n_a) :
+                            x += dist_transition[d-1-p, j, k] * eo[k]
+                        right[j] = x
+                else :
+                    right[:] = nb
+                for j in range(n_a) :
+                    prev[j] = right[j]
+                    right[j] *= emission[j, 0]
+            if p > 0 :
+                s = 0.
+                for j in range(n_a) :
+                    s += left[j] * prev_right[j]
+                for j in range(n_a) :
+                    b2[j, 0] += left[j] * prev_right[j] / s
+            prev_right[:] = prev
+            if not gammaOnly :
+                s = 0.
+                for j in range(n_a) :
+                    for k in range(n_a) :
+                        t[j, k] = left[j] * right[k] * transition[j, k]
+                        s += t[j, k]
+                for j in range(n_a) :
+                    for k in range(n_a) :
+                        a2[j, k] += t[j, k] / s
+
+    a2[0] += gamma[0]
+    a2[:, 0] += gamma[-1]
+    return a2, b2, gamma
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def measure_blocks(pi, transition, emission, dist_transition, dist_transition_adj, dist_transition_slope, saturate_id, state, gap, bounds, gammaOnly) :
+    # E-step over consecutive blocks of one branch, rows bounds[i]:bounds[i+1] being block i
+    n_a = transition.shape[0]
+    bv = np.ascontiguousarray(emission.T)
+    a2, b2 = np.zeros(shape=(n_a, n_a)), np.zeros(shape=emission.shape)
+    gamma = np.zeros(shape=(state.size if gammaOnly else 0, n_a))
+    probability = 0.
+    for i in range(bounds.size-1) :
+        o, d = state[bounds[i]:bounds[i+1]], gap[bounds[i]:bounds[i+1]]
+        alpha_Pr, alpha, beta = scaled_forward_backward(pi, dist_transition, dist_transition_adj, dist_transition_slope, bv, o, d)
+        a, b, g = accumulate_expected_counts(transition, emission, o, d, alpha, beta, dist_transition, saturate_id, gammaOnly)
+        a2 += a
+        b2 += b
+        if gammaOnly :
+            gamma[bounds[i]:bounds[i+1]] = g
+        probability += alpha_Pr
+    return probability, a2, b2, gamma
+
+
+@jit(nopython=True, cache=True)
+def _add_viterbi_run(runs, n_run, lo, hi, state, n_base) :
+    lo, hi = max(lo, 1), min(hi, n_base-2)
+    if state > 0 and lo <= hi :
+        if n_run > 0 and runs[n_run-1, 0] == hi+1 :
+            runs[n_run-1, 0] = lo
+        else :
+            if n_run >= runs.shape[0] :
+                runs = np.vstack((runs, np.zeros_like(runs)))
+            runs[n_run, 0], runs[n_run, 1], runs[n_run, 2] = lo, hi, state
+            n_run += 1
+    return runs, n_run
+
+
+@jit(nopython=True, cache=True)
+def _fill_viterbi_chunk(powers, steady, t, s, e, start, runs, n_run, n_base) :
+    # sites strictly inside the best 2^t-step path from s at start to e at start+2^t,
+    # visited right to left. t < 0 marks a single site.
+    stack = np.zeros(shape=(2*t+3, 4), dtype=np.int64)
+    stack[0, 0], stack[0, 1], stack[0, 2], stack[0, 3] = t, s, e, start
+    n_stack = 1
+    while n_stack :
+        n_stack -= 1
+        t, s, e, start = stack[n_stack, 0], stack[n_stack, 1], stack[n_stack, 2], stack[n_stack, 3]
+        if t < 0 :
+            runs, n_run = _add_viterbi_run(runs, n_run, start, start, s, n_base)
+        elif t == 0 :
+            continue
+        elif s == e and steady[t, s] :
+            runs, n_run = _add_viterbi_run(runs, n_run, start+1, start+(1 << t)-1, s, n_base)
+        else :
+            m = 0
+            for x in range(1, powers.shape[1]) :
+                if powers[t-1, s, x] + powers[t-1, x, e] > powers[t-1, s, m] + powers[t-1, m, e] :
+                    m = x
+            h = 1 << (t-1)
+            stack[n_stack, 0], stack[n_stack, 1], stack[n_stack, 2], stack[n_stack, 3] = t-1, s, m, start
+            stack[n_stack+1, 0], stack[n_stack+1, 1], stack[n_stack+1, 2], stack[n_stack+1, 3] = -1, m, m, start+h
+            stack[n_stack+2, 0], stack[n_stack+2, 1], stack[n_stack+2, 2], stack[n_stack+2, 3] = t-1, m, e, start+h
+            n_stack += 3
+    return runs, n_run
+
+
+@jit(nopython=True, fastmath=True, cache=True)
+def sparse_viterbi(pa, pb, init, term, state, gap, pos) :
+    n_obs, n_a = state.size, pa.shape[0]
+    n_base = pos[-1] + 1
+
+    # max-plus powers of a mutation-free step: powers[t] = M^(2^t).
+    # steady[t, s] flags that the best path s -> s over 2^t steps never leaves s
+    n_pow = 1
+    while (1 << n_pow) <= np.max(gap) :
+        n_pow += 1
+    powers = np.zeros(shape=(n_pow, n_a, n_a))
+    steady = np.zeros(shape=(n_pow, n_a), dtype=np.bool_)
+    for j in range(n_a) :
+        steady[0, j] = True
+        for k in range(n_a) :
+            powers[0, j, k] = pa[j, k] + pb[k, 0]
+    for t in range(1, n_pow) :
+        for j in range(n_a) :
+            for k in range(n_a) :
+                m = 0
+                for x in range(1, n_a) :
+                    if powers[t-1, j, x] + powers[t-1, x, k] > powers[t-1, j, m] + powers[t-1, m, k] :
+                        m = x
+                powers[t, j, k] = powers[t-1, j, m] + powers[t-1, m, k]
+                if j == k :
+                    steady[t, j] = steady[t-1, j] and m == j
+
+    # forward pass, one max-plus product per set bit of each gap
+    alpha = np.zeros(shape=(n_obs, n_a))
+    v, w = np.zeros(n_a), np.zeros(n_a)
+    for k in range(n_a) :
+        alpha[0, k] = init[k] + pb[k, state[0]]
+    for i in range(1, n_obs) :
+        v[:] = alpha[i-1]
+        n = gap[i] - 1
+        for t in range(n_pow-1, -1, -1) :
+            if n & (1 << t) :
+                for k in range(n_a) :
+                    w[k] = v[0] + powers[t, 0, k]
+                    for j in range(1, n_a) :
+                        if v[j] + powers[t, j, k] > w[k] :
+                            w[k] = v[j] + powers[t, j, k]
+                v[:] = w
+        for k in range(n_a) :
+            alpha[i, k] = v[0] + pa[0, k]
+            for j in range(1, n_a) :
+                if v[j] + pa[j, k] > alpha[i, k] :
+                    alpha[i, k] = v[j] + pa[j, k]
+            alpha[i, k] += pb[k, state[i]]
+
+    # backtrack from the right end, collecting runs of non-zero states over sites
+    # 1 .. n_base-2 as [lo, hi, state at hi]
+    runs = np.zeros(shape=(max(n_obs//4, 16), 3), dtype=np.int64)
+    n_run = 0
+    chunk_alpha = np.zeros(shape=(n_pow+1, n_a))
+    chunk_pow, chunk_start = np.zeros(n_pow, dtype=np.int64), np.zeros(n_pow, dtype=np.int64)
+
+    cur = 0
+    for k in range(1, n_a) :
+        if alpha[-1, k] + term[k] > alpha[-1, cur] + term[cur] :
+            cur = k
+    for i in range(n_obs-1, 0, -1) :
+        runs, n_run = _add_viterbi_run(runs, n_run, pos[i], pos[i], cur, n_base)
+        n, n_chunk, start = gap[i] - 1, 0, pos[i-1]
+        chunk_alpha[0] = alpha[i-1]
+        for t in range(n_pow-1, -1, -1) :
+            if n & (1 << t) :
+                for k in range(n_a) :
+                    chunk_alpha[n_chunk+1, k] = chunk_alpha[n_chunk, 0] + powers[t, 0, k]
+                    for j in range(1, n_a) :
+                        if chunk_alpha[n_chunk, j] + powers[t, j, k] > chunk_alpha[n_chunk+1, k] :
+                            chunk_alpha[n_chunk+1, k] = chunk_alpha[n_chunk, j] + powers[t, j, k]
+                chunk_pow[n_chunk], chunk_start[n_chunk] = t, start
+                start += 1 << t
+                n_chunk += 1
+        prev = 0
+        for j in range(1, n_a) :
+            if chunk_alpha[n_chunk, j] + pa[j, cur] > chunk_alpha[n_chunk, prev] + pa[prev, cur] :
+                prev = j
+        cur = prev
+        for c in range(n_chunk-1, -1, -1) :
+            t, start = chunk_pow[c], chunk_start[c]
+            runs, n_run = _add_viterbi_run(runs, n_run, start + (1 << t), start + (1 << t), cur, n_base)
+            prev = 0
+            for j in range(1, n_a) :
+                if chunk_alpha[c, j] + powers[t, j, cur] > chunk_alpha[c, prev] + powers[t, prev, cur] :
+                    prev = j
+            runs, n_run = _fill_viterbi_chunk(powers, steady, t, prev, cur, start, runs, n_run, n_base)
+            cur = prev
+    return runs[:n_run]
+
+
+def _intervals(intervals) :
+    # sorted, merged [start, end] intervals and the cumulative number of positions they cover
+    intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    intervals = intervals[intervals.T[1] >= intervals.T[0]]
+    if intervals.shape[0] :
+        intervals = intervals[np.argsort(intervals.T[0], kind='mergesort')]
+        ends = np.maximum.accumulate(intervals.T[1])
+        first = np.concatenate([[True], intervals[1:, 0] > ends[:-1] + 1])
+        last = np.concatenate([first[1:], [True]])
+        intervals = np.vstack([intervals[first, 0], ends[last]]).T
+    return intervals, np.concatenate([[0], np.cumsum(intervals.T[1] - intervals.T[0] + 1)])
+
+
+def _covered(intervals, cum, p) :
+    # number of covered positions before p, and whether p itself is covered
+    p = np.asarray(p, dtype=np.int64)
+    if intervals.shape[0] == 0 :
+        return np.zeros_like(p), np.zeros(p.shape, dtype=bool)
+    k = np.searchsorted(intervals.T[0], p, 'right')
+    end = intervals[np.maximum(k-1, 0), 1]
+    inside = (k > 0) & (end >= p)
+    return cum[k] - np.where(inside, end - p + 1, 0), inside
+
+
+def compress_coordinates(seqLen, regions, missing, sites) :
+    # (block, position) of the sites of one sequence once the missing regions are dropped
+    # and every block is numbered from its left anchor, plus the number of kept positions.
+    # Same as marking a per-base array, in the number of intervals and sites instead
+    missing, cum = _intervals(missing)
+    def value(p) :
+        before, inside = _covered(missing, cum, p)
+        return np.where(inside, -2, p - before), inside
+
+    def present(lo, hi) :
+        return (hi - lo + 1) - (_covered(missing, cum, hi+1)[0] - _covered(missing, cum, lo)[0])
+
+    r1, r2, blkIds = regions.T[1], regions.T[2], regions.T[4]
+    (v0, m0), (v1, m1), (v2, m2) = value(r1-1), value(r1), value(r2)
+    shift = v1 > 1
+    base = np.where(shift, v1 - 1, v0)
+    last = np.where(m2, missing[np.maximum(np.searchsorted(missing.T[0], r2, 'right')-1, 0), 0] - 1 if missing.shape[0] else r2, r2)
+    top = np.where(last >= r1, value(last)[0], v2) - base
+    end = np.where(v2 - base > 0, v2 - base + 1, top + 1)
+    kept = np.where(shift | ~m0, 1 + present(r1, r2), r2 - r1 + 2) + (end >= 0)
+    n_base = present(0, seqLen+1) - np.sum(present(r1-1, r2+1)) + np.sum(kept)
+
+    values = value(sites)[0]
+    k = np.searchsorted(r1-1, sites, 'right') - 1
+    kk = np.maximum(k, 0)
+    inblock = (k >= 0) & (sites <= r2[kk]+1)
+    pos = np.where(inblock, values - base[kk], values)
+    pos[inblock & shift[kk] & (sites == r1[kk]-1)] = 0
+    pos[inblock & (sites == r2[kk]+1)] = end[kk][inblock & (sites == r2[kk]+1)]
+    return int(n_base), np.vstack([np.where(inblock, blkIds[kk], 0), pos]).T
+
+
+class Model(object) :
+    # a candidate model of BaumWelch, read and written like the dict it is saved as. Copies share
+    # the per-branch posterior and EventFreq, which are replaced but never edited in place, and
+    # take their own parameters and categories, which verify_model edits
+    __slots__ = ('theta', 'R', 'delta', 'delta2', 'v', 'v2', 'h', 'EventFreq', 'categories', 'posterior', 'probability', 'diff', 'id', 'ite')
+
+    def __init__(self, **fields) :
+        self.update(fields)
+
+    def __getitem__(self, k) :
+        try :
+            return getattr(self, k)
+        except AttributeError :
+            raise KeyError(k)
+
+    def __setitem__(self, k, v) :
+        setattr(self, k, v)
+
+    def __contains__(self, k) :
+        return k in self.__slots__ and hasattr(self, k)
+
+    def keys(self) :
+        return [ k for k in self.__slots__ if hasattr(self, k) ]
+
+    def items(self) :
+        return [ (k, getattr(self, k)) for k in self.keys() ]
+
+    def get(self, k, default=None) :
+        return getattr(self, k, default) if k in self.__slots__ else default
+
+    def pop(self, k, *default) :
+        if k not in self :
+            if default :
+                return default[0]
+            raise KeyError(k)
+        v = getattr(self, k)
+        delattr(self, k)
+        return v
+
+    def update(self, fields=(), **kwargs) :
+        for k, v in dict(fields, **kwargs).items() :
+            setattr(self, k, v)
+
+    def copy(self) :
+        model = Model(**dict(self.items()))
+        for k in ('theta', 'R', 'delta', 'delta2', 'v', 'v2', 'h') :
+            if k in model :
+                model[k] = copy.copy(model[k])
+        if 'categories' in model :
+            model['categories'] = { k:copy.copy(v) for k, v in model['categories'].items() }
+        return model
 
 
 class recHMM(object) :
-    def __init__(self, prefix, mode=1) :
+    def __init__(self, prefix, mode=1, n_proc=5, cache=None, pool=None, model_format='npz') :
         self.prefix = prefix
+        self.model_file = '{0}.best.model.{1}'.format(prefix, model_format)
+        self.n_proc, self.pool = n_proc, pool
+        self.cache = cache
+        self.engine, self.prepared = None, None
         self.max_iteration = 200
         self.n_base = None
+        self.frozen = {}
         self.mode = ['legacy', 'hybrid', 'intra', 'both'][mode]
         self.n_a, self.n_b = [[2, 2], [4, 3], [2, 3], [3, 3]][mode]
 
-    def fit(self, mutations, branches=None, sequences=None, missing=[], categories=None, init=None, cool_down=5) :
-        self.observations = self.prepare_branches(mutations, sequences, missing, interval=None)
+    def __getstate__(self) :
+        # what the Pool workers need; the observations go as a handle to the shared store
+        return { k:v for k, v in self.__dict__.items() if k in ('prefix', 'mode', 'n_a', 'n_b', 'n_base', 'observations') }
+
+    def fit(self, mutations, branches=None, sequences=None, missing=[], categories=None, init=None, cool_down=5, resume=False, accelerate=False) :
+        self.prepare(mutations, sequences, missing)
         self.branches = branches if branches is not None else np.arange(len(self.observations)).astype(str)
+        self.set_categories(categories)
+
+        self.accelerate, self.squarem = accelerate, dict(previous={}, fallback={})
+        if resume and os.path.isfile(self.prefix + '.rec.checkpoint.pkl') :
+            models, start = self.restore()
+            self.model = models[0]
+            print('Resume from iteration {0} saved in {1}'.format(start, self.prefix + '.rec.checkpoint.pkl'))
+        else :
+            models, start = self.initiate(self.observations, init=init), 0
+        return self.BaumWelch(models, self.max_iteration, cool_down=cool_down, start=start)
+
+    def update(self, mutations, branches=None, sequences=None, missing=[], categories=None, cool_down=5, accelerate=False, tolerance=.05) :
+        # warm-starts EM from the loaded model. Branches whose observations did not change keep
+        # their saved posteriors and skip the E-step; once converged they are assessed again, and
+        # those whose EventFreq moved by more than <tolerance> take part in another round
+        saved, fitted = self.model, self.fitted_branches
+        self.prepare(mutations, sequences, missing)
+        self.branches = branches if branches is not None else np.arange(len(self.observations)).astype(str)
+        self.set_categories(categories)
+
+        self.accelerate, self.squarem = accelerate, dict(previous={}, fallback={})
+        model = self.warm_start(saved, fitted)
+        print('Update from the saved model: {0} of {1} branches are unchanged'.format(len(self.frozen), len(self.branches)))
+        model = self.BaumWelch([model], self.max_iteration, cool_down=cool_down)
+        freq = lambda p : p['theta'][1]/p['theta'][0] + np.sum(p['R'][1:])/p['R'][0]
+        while self.frozen :
+            frozen, self.frozen = self.frozen, {}
+            prediction = self.estimation(model, self.get_model_measures([self.update_branch_parameters(model)])[0])
+            posterior = [ { k:v[brId] for k, v in prediction['posterior'].items() } for brId in range(len(self.branches)) ]
+            shifted = [ brId for brId, p in frozen.items() if abs(freq(posterior[brId]) - freq(p)) > tolerance * freq(p) ]
+            if len(shifted) == 0 :
+                break
+            print('Posteriors of {0} unchanged branches shifted. Update again with them. '.format(len(shifted)))
+            self.frozen = { brId:posterior[brId] for brId in frozen if brId not in shifted }
+            prediction['diff'], prediction['ite'] = 1e300, model['ite']
+            model = self.BaumWelch([prediction], self.max_iteration, cool_down=cool_down)
+        self.frozen = {}
+        return model
+
+    def warm_start(self, saved, fitted) :
+        # the saved model on the current branches. Saved branches keep their EventFreq and categories,
+        # new ones start in the default categories at the EventFreq of their mutation density
+        index = { name:id for id, name in enumerate(fitted) }
+        old = np.array([ index.get(str(name), -1) for name in self.branches ], dtype=int)
+        known = old >= 0
+        model = saved.copy()
+        for c, keys in (('R/theta', ('theta', 'R')), ('nu', ('v', 'v2')), ('delta', ('delta', 'delta2'))) :
+            n = np.asarray(model[keys[0]]).shape[0]
+            model['categories'][c] = np.where(known, np.asarray(saved['categories'][c])[np.maximum(old, 0)], np.where(self.categories[c] < n, self.categories[c], 0))
+        model['categories']['noRec'] = { brId:saved['categories']['noRec'][o] for brId, o in enumerate(old) if o in saved['categories'].get('noRec', {}) }
+        density = np.array([ np.sum([ np.sum(obs.state > 0) for obs in observation ]) for observation in self.observations ])/float(self.n_base)
+        model['EventFreq'] = np.where(known, np.asarray(saved['EventFreq'])[np.maximum(old, 0)], density/np.asarray(model['theta'])[model['categories']['R/theta']])
+        model.update(probability=-1e300, diff=1e300, ite=0)
+        model.pop('posterior', None)
+
+        self.frozen = {}
+        if 'posterior' in saved :
+            for brId, (o, name) in enumerate(zip(old, self.branches)) :
+                if o >= 0 and fitted[str(name)] == self.observations.digest(brId) :
+                    self.frozen[brId] = { k:v[o] for k, v in saved['posterior'].items() }
+        return model
+
+    def set_categories(self, categories) :
         self.categories = { 'noRec':{} }
         for c, assigns in categories.items() :
             self.categories[c] = np.zeros(shape=[len(self.branches)], dtype=int)
@@ -55,45 +772,104 @@ class recHMM(object) :
                 for i, n in enumerate(self.branches) :
                     self.categories[c][i] = categories[c].get(n, 0)
 
-        models = self.initiate(self.observations, init=init)
-        return self.BaumWelch(models, self.max_iteration, cool_down=cool_down)
-
-    def save(self, fout):
+    def checkpoint(self, models, ite) :
+        # complete state of BaumWelch, atomically replaced after every iteration
+        state = dict(models=models, ite=ite, squarem=self.squarem, n_branch=len(self.observations), n_base=self.n_base)
+        _replace_file(self.prefix + '.rec.checkpoint.pkl', lambda fout : pickle.dump(state, fout))
+
+    def restore(self) :
+        with open(self.prefix + '.rec.checkpoint.pkl', 'rb') as fin :
+            state = pickle.load(fin)
+        assert state['n_branch'] == len(self.observations) and state['n_base'] == self.n_base, 'Checkpoint does not match the data'
+        # checkpoints written before the Model class hold plain dicts
+        as_model = lambda m : m if isinstance(m, Model) else Model(**m)
+        self.squarem = { k:{ id:as_model(m) for id, m in v.items() } for k, v in state.get('squarem', self.squarem).items() }
+        return [ as_model(m) for m in state['models'] ], state['ite']
+
+    def save(self, fout) :
+        # <fout> is an open file, which takes JSON, or a file name. Names ending in .npz take the binary
+        # format, which load() maps from the file; named files are written aside and then renamed, so
+        # that an interrupted run never leaves half a model
         import json
-        model = copy.deepcopy(self.model)
+        model = dict(self.model.items())
         model['model'] = dict(
             n_a = self.n_a,
             n_b = self.n_b,
             n_base = self.n_base,
+            branches = [ str(name) for name in self.branches ],
+            digests = [ self.observations.digest(brId) for brId in range(len(self.observations)) ],
         )
+        if isinstance(fout, str) and fout.endswith('.npz') :
+            # flat arrays named <field> or <field>/<key>; noRec and low_cov as [n, 2] arrays of their items
+            arrays = {}
+            for k, v in model.items() :
+                if isinstance(v, dict) :
+                    for k2, v2 in v.items() :
+                        arrays[k + '/' + k2] = np.array(sorted(v2.items()), dtype=int).reshape(-1, 2) if isinstance(v2, dict) else np.asarray(v2)
+                else :
+                    arrays[k] = np.asarray(v)
+            _replace_file(fout, lambda f : np.savez(f, **arrays))
+            return self.model
+
         for k in ('v', 'v2', 'R', 'EventFreq', 'theta', 'delta', 'delta2') :
             model[k] = model[k].tolist()
         if 'posterior' in model :
             model['posterior'] = { k:v.tolist() for k,v in model['posterior'].items() }
         if 'categories' in model:
+            model['categories'] = dict(model['categories'])
             for k in ('R/theta', 'nu', 'delta') :
                 model['categories'][k] = model['categories'][k].tolist()
-        json.dump(model, fout)
+        if isinstance(fout, str) :
+            _replace_file(fout, lambda f : f.write(json.dumps(model).encode()))
+        else :
+            json.dump(model, fout)
         return self.model
 
     def load(self, fin) :
-        import json
-        model = json.load(fin)
-        for k in ('v', 'v2', 'R', 'EventFreq', 'theta', 'delta') :
-            model[k] = np.array(model[k])
-        if 'posterior' in model :
-            model['posterior'] = { k:np.array(v) for k,v in model['posterior'].items() }
-        if 'categories' in model:
-            for k in ('R/theta', 'nu', 'delta') :
-                model['categories'][k] = np.array(model['categories'][k])
-        self.__dict__.update(model.pop('model', {}))
-        self.model = model
+        # <fin> is an open JSON file or the name of a saved model in either format
+        import json, zipfile
+        if isinstance(fin, str) and zipfile.is_zipfile(fin) :
+            model = {}
+            for k, v in _read_npz(fin).items() :
+                v = v.item() if v.ndim == 0 else v
+                if '/' in k :
+                    k, k2 = k.split('/', 1)
+                    model.setdefault(k, {})[k2] = v
+                else :
+                    model[k] = v
+            model['h'] = model['h'].tolist()
+            for k in ('noRec', 'low_cov') :
+                if k in model.get('categories', {}) :
+                    model['categories'][k] = dict(model['categories'][k].tolist())
+            for k in ('branches', 'digests') :
+                if k in model.get('model', {}) :
+                    model['model'][k] = model['model'][k].tolist()
+        else :
+            if isinstance(fin, str) :
+                with open(fin) as f :
+                    model = json.load(f)
+            else :
+                model = json.load(fin)
+            for k in ('v', 'v2', 'R', 'EventFreq', 'theta', 'delta', 'delta2') :
+                model[k] = np.array(model[k])
+            if 'posterior' in model :
+                model['posterior'] = { k:np.array(v) for k,v in model['posterior'].items() }
+            if 'categories' in model:
+                for k in ('R/theta', 'nu', 'delta') :
+                    model['categories'][k] = np.array(model['categories'][k])
+                for k in ('noRec', 'low_cov') :
+                    if k in model['categories'] :
+                        model['categories'][k] = { int(i):v for i, v in model['categories'][k].items() }
+        info = model.pop('model', {})
+        self.fitted_branches = dict(zip(info.pop('branches', []), info.pop('digests', [])))
+        self.__dict__.update(info)
+        self.model = Model(**model)
         return self.model
 
 
     def initiate(self, observations, init) :
         criteria = np.array(init.split(',')).astype(float)
-        intervals = np.sort(np.concatenate([ np.diff(obs[obs.T[3] > 0, 5]) for observation in observations for obs in observation ]))
+        intervals = np.sort(np.concatenate([ np.diff(obs.pos[obs.state > 0]) for observation in observations for obs in observation ]))
         criteria = (criteria * intervals.size).astype(int)
         cutoffs = np.unique(intervals[criteria])
 
@@ -103,29 +879,29 @@ class recHMM(object) :
             for x, observation in enumerate(observations) :
                 mut = []
                 for obs in observation :
-                    substitution = obs[obs.T[3] > 0]
+                    substitution = np.vstack([obs.state, obs.pos]).T[obs.state > 0]
                     if len(substitution) :
-                        substitution = np.vstack([obs[-1, :-1].tolist()+[-(obs[-1, -1] - substitution[-1, -1])], substitution])
+                        substitution = np.vstack([[obs.state[-1], -(obs.pos[-1] - substitution[-1, -1])], substitution])
                         dist = np.diff(substitution.T[-1])
                         inRec = np.concatenate([[False], (dist <= cutoff)[1:], [False]])
                         edges = np.concatenate([[0], np.diff(inRec.astype(int))])
-                        mutSites = substitution[~(inRec | np.concatenate([[False], inRec[:-1]])), 3]
-                        edgeSites = substitution[np.where(edges != 0), 3]
+                        mutSites = substitution[~(inRec | np.concatenate([[False], inRec[:-1]])), 0]
+                        edgeSites = substitution[np.where(edges != 0), 0]
 
                         recRegion = []
                         for s, e in np.vstack([np.where(edges > 0), np.where(edges < 0)]).T :
                             r = substitution[np.arange(s, e+1)]
-                            recRegion.append([1, r[-1, -1] - r[0, -1], r.shape[0]-1, (np.sum((r[1:-1, 3]-1)/r[1:-1, 3]) + np.sum((r.T[3]-1)/r.T[3]))/2])
+                            recRegion.append([1, r[-1, -1] - r[0, -1], r.shape[0]-1, (np.sum((r[1:-1, 0]-1)/r[1:-1, 0]) + np.sum((r.T[0]-1)/r.T[0]))/2])
                         if len(recRegion) :
                             recRegion = np.array(recRegion)
                             rec.append(recRegion)
                             mut.append([ substitution[-1, -1] - substitution[0, -1] - np.sum(recRegion.T[1]), substitution.shape[0]-1 - np.sum(recRegion.T[2]), 
-                                                 np.sum((substitution[1:, 3] - 1)/substitution[1:, 3])-np.sum(recRegion.T[3]), recRegion.shape[0] ])
+                                                 np.sum((substitution[1:, 0] - 1)/substitution[1:, 0])-np.sum(recRegion.T[3]), recRegion.shape[0] ])
                         else :
                             mut.append([ substitution[-1, -1] - substitution[0, -1], substitution.shape[0]-1, 
-                                                 np.sum((substitution[1:, 3] - 1)/substitution[1:, 3]), 0 ])
+                                                 np.sum((substitution[1:, 0] - 1)/substitution[1:, 0]), 0 ])
                     else :
-                        mut.append([ obs[-1, -1] - obs[0, -1], 0, 0, 0 ])
+                        mut.append([ obs.pos[-1] - obs.pos[0], 0, 0, 0 ])
                 mut_summary.append(np.sum(mut, 0))
             
             mut_summary = np.array(mut_summary)
@@ -134,14 +910,14 @@ class recHMM(object) :
             EventFreq = np.sum(mut_summary.T[[1, 3]]/mut_summary.T[0], 0)
 
             n_br, (bases, muts, homos, recs) = mut_summary.shape[0], np.sum(mut_summary, 0)
-            model = dict(theta = np.array([ muts/np.sum(EventFreq)/self.n_base for id in np.unique(self.categories['R/theta']) ]),
+            model = Model(theta = np.array([ muts/np.sum(EventFreq)/self.n_base for id in np.unique(self.categories['R/theta']) ]),
                          h     = [ max(0.01, min(0.95, homos/muts)), max(0.01, min(0.95, 1-(1-homos/muts)**3)) ],
                          probability = -1e300,
                          diff        = 1e300,
                          EventFreq   = EventFreq,
                          id          = len(self.models) + 1,
                          ite         = 0,
-                         categories  = copy.deepcopy(self.categories)
+                         categories  = { k:copy.copy(v) for k, v in self.categories.items() }
                         )
 
             rec = np.vstack(rec)
@@ -167,30 +943,43 @@ class recHMM(object) :
         return self.models
 
 
-    def BaumWelch(self, models, max_iteration, cool_down=5) :
+    def BaumWelch(self, models, max_iteration, cool_down=5, start=0) :
         n_model = len(models)
-        for ite in range(max_iteration) :
+        for ite in range(start, max_iteration) :
             new_models = []
             self.model = models[0]
 
+            batch = iter(self.get_model_measures([ self.update_branch_parameters(model) for model in models if not ('diff' in model and model['diff'] < 0.001) ], \
+                                                 skip=self.frozen))
             for model in models:
                 if 'diff' in model and model['diff'] < 0.001 :
                     new_models.append(model)
                 else :
                     print('')
                     self.screen_out('Assess', model)
-                    #t = time()
-                    branch_params = self.update_branch_parameters(model)
-                    branch_measures = self.get_branch_measures(branch_params, self.observations)
-                    #print(time() - t)
+                    branch_measures = next(batch)
                     prediction = self.estimation(model, branch_measures)
                     prediction['diff'] = -prediction['probability'] if not model['probability'] else prediction['probability'] - model['probability']
+                    fallback = self.squarem['fallback'].pop(model['id'], None)
+                    if fallback is not None and prediction['diff'] <= 0 :
+                        # extrapolated parameters reduced the likelihood, take the plain EM step instead
+                        self.screen_out('Fallback', fallback)
+                        new_models.append(fallback)
+                        continue
                     if prediction['diff'] > 0 :
                         prediction['ite'] = ite+1
                         self.screen_out('Update', prediction)
-                        new_models.append(prediction)
+                        previous = self.squarem['previous'].pop(model['id'], None)
+                        accelerated = self.extrapolate(previous, model, prediction) if self.accelerate and previous is not None and model['probability'] > -1e200 else None
+                        if accelerated is not None :
+                            self.squarem['fallback'][model['id']] = prediction
+                            self.screen_out('Accelerate', accelerated)
+                            new_models.append(accelerated)
+                        else :
+                            self.squarem['previous'][model['id']] = model
+                            new_models.append(prediction)
                     else :
-                        curr_model = copy.deepcopy(model)
+                        curr_model = model.copy()
                         curr_model['diff'] = prediction['diff']
                         self.screen_out('Freeze', curr_model)
                         new_models.append(curr_model)
@@ -210,11 +999,39 @@ class recHMM(object) :
                         self.screen_out('Delete', new_models[-1])
                         new_models = new_models[:-1]
                 self.verify_model(new_models)
-                self.save(open(self.prefix + '.best.model.json', 'w'))
+                self.save(self.model_file)
             models = new_models
+            self.checkpoint(models, ite+1)
         self.screen_out('Report', models[0])
         return models[0]
 
+    def extrapolate(self, m0, m1, m2, max_step=4.) :
+        # SQUAREM step over three successive EM estimates, in log scale to keep the parameters positive
+        keys = ('theta', 'R', 'delta', 'delta2', 'v', 'v2', 'h')
+        p0, p1, p2 = [[np.array(m[k], dtype=float) for k in keys] for m in (m0, m1, m2)]
+        if [p.shape for p in p0] != [p.shape for p in p2] or [p.shape for p in p1] != [p.shape for p in p2] :
+            return None
+        masks = [(x0 > 0) & (x1 > 0) & (x2 > 0) for x0, x1, x2 in zip(p0, p1, p2)]
+        r = np.concatenate([np.log(x1[m]) - np.log(x0[m]) for x0, x1, m in zip(p0, p1, masks)])
+        v = np.concatenate([np.log(x2[m]) - 2*np.log(x1[m]) + np.log(x0[m]) for x0, x1, x2, m in zip(p0, p1, p2, masks)])
+        if np.sum(v**2) <= 0 :
+            return None
+        alpha = min(max(-np.sqrt(np.sum(r**2)/np.sum(v**2)), -max_step), -1.)
+        if alpha == -1. :
+            return None
+
+        model = m2.copy()
+        for k, x0, x1, x2, m in zip(keys, p0, p1, p2, masks) :
+            x = x2.copy()
+            x[m] = np.exp(np.log(x0[m]) - 2*alpha*(np.log(x1[m]) - np.log(x0[m])) + alpha**2*(np.log(x2[m]) - 2*np.log(x1[m]) + np.log(x0[m])))
+            model[k] = x
+        model['delta'], model['delta2'] = np.clip(model['delta'], .00001, .05), np.clip(model['delta2'], .00001, .05)
+        model['v'], model['v2'] = np.clip(model['v'], 0.0001, 0.7), np.clip(model['v2'], 0.0001, 0.7)
+        model['h'] = np.minimum(model['h'], 0.95).tolist()
+        tot_event = model['theta'] + np.sum(model['R'], 1)
+        model['theta'], model['R'] = model['theta']/tot_event, model['R']/tot_event[:, np.newaxis]
+        return model
+
     def verify_model(self, models) :
         for model in models :
             if 'low_cov' not in model['categories'] :
@@ -224,31 +1041,38 @@ class recHMM(object) :
                     model['h'][0] = model['h'][1] / 1.5
                     model['probability'] = -1e300
                     model['diff'] = 1e300
-            for brId, (theta, v) in enumerate(zip(model['posterior']['theta'], model['posterior']['v'])) :
-                if theta[1] > 0.74 * theta[0] :
-                    theta[1] = 0.74 * theta[0]
-                if v[1] > 0.74 * v[0]:
-                    v[1] = 0.74 * v[0]
-
-                m = - 3. / 4. * np.log(1 - 4. / 3. * theta[1] / theta[0])
-                r = - 3. / 4. * np.log(1 - 4. / 3. * v[1] / v[0])
-                if v[0] > .05 * theta[0] and r < 3. * m and np.sum(model['categories']['nu'] == model['categories']['nu'][brId]) > 2 :
-                    model['categories']['nu'][brId] = new_id = model['categories']['nu'][brId] + 1
+            # the tests run over all branches at once; only the flagged branches are moved, in order,
+            # as each move changes the categories seen by the next one
+            theta, v = model['posterior']['theta'].copy(), model['posterior']['v'].copy()
+            theta[:, 1], v[:, 1] = np.minimum(theta[:, 1], 0.74 * theta[:, 0]), np.minimum(v[:, 1], 0.74 * v[:, 0])
+            model['posterior'] = dict(model['posterior'], theta=theta, v=v)
+            m = - 3. / 4. * np.log(1 - 4. / 3. * theta[:, 1] / theta[:, 0])
+            r = - 3. / 4. * np.log(1 - 4. / 3. * v[:, 1] / v[:, 0])
+            divergent = (v[:, 0] > .05 * theta[:, 0]) & (r < 3. * m)
+            low_cov = model['posterior']['R'][:, 0] * 2. < self.n_base
+            nu_count, rt_count = list(np.bincount(model['categories']['nu'])), list(np.bincount(model['categories']['R/theta']))
+            for brId in np.flatnonzero(divergent | low_cov) :
+                nu = model['categories']['nu'][brId]
+                if divergent[brId] and nu_count[nu] > 2 :
+                    model['categories']['nu'][brId] = new_id = nu + 1
+                    nu_count[nu] -= 1
+                    nu_count.extend([0] * (new_id + 1 - len(nu_count)))
+                    nu_count[new_id] += 1
                     print('Model {0}: Branch {1} is too divergent for the current setting of external recombination. Move to category {2} '.format(model['id'], self.branches[brId], new_id))
                     if new_id >= model['v'].shape[0] :
                         model['v'] = np.concatenate([model['v'], [0.]])
                         model['v2'] = np.concatenate([model['v2'], [model['v2'][-1]]])
                     rn = - 3. / 4. * np.log(1 - 4. / 3. * model['v'][new_id])
-                    if rn < m * 3. :
-                        model['v'][new_id] = 3./4.*(1-np.exp(-4.*m))
-                    if model['v2'][new_id] < theta[1]/theta[0]*0.5 :
-                        model['v2'][new_id] = theta[1]/theta[0]*0.5
+                    if rn < m[brId] * 3. :
+                        model['v'][new_id] = 3./4.*(1-np.exp(-4.*m[brId]))
+                    if model['v2'][new_id] < theta[brId, 1]/theta[brId, 0]*0.5 :
+                        model['v2'][new_id] = theta[brId, 1]/theta[brId, 0]*0.5
                     model['probability'] = -1e300
                     model['diff'] = 1e300
-                elif model['posterior']['R'][brId, 0] * 2. < self.n_base :
+                elif low_cov[brId] :
                     tId = int(model['categories']['R/theta'][brId])
                     if tId not in model['categories']['low_cov'] :
-                        if np.sum(model['categories']['R/theta']== tId) > 1:
+                        if rt_count[tId] > 1:
                             model['categories']['low_cov'][tId] = int(model['theta'].size)
                             model['categories']['low_cov'][int(model['theta'].size)] = int(model['theta'].size)
                             model['R'] = np.vstack([model['R'], [model['R'][tId]]])
@@ -257,7 +1081,10 @@ class recHMM(object) :
                             model['categories']['low_cov'][tId] = tId
                     if model['categories']['low_cov'][tId] != tId :
                         print('Model {0}: The recombination frequency in Branch {1} is suspiciously high. Try to infer its frequency independently. '.format(model['id'], self.branches[brId]))
-                        model['categories']['R/theta'][brId] = model['categories']['low_cov'][tId]
+                        model['categories']['R/theta'][brId] = new_id = model['categories']['low_cov'][tId]
+                        rt_count[tId] -= 1
+                        rt_count.extend([0] * (new_id + 1 - len(rt_count)))
+                        rt_count[new_id] += 1
                         model['probability'] = -1e300
                         model['diff'] = 1e300
             c, cnt = np.unique(model['categories']['nu'], return_counts=True)
@@ -284,24 +1111,32 @@ class recHMM(object) :
                           v2=np.zeros([len(branch_measures), 2]),
                           probability=np.zeros(len(branch_measures)), )
 
-        for id, measures in enumerate(branch_measures) :
-            a, b = measures['a'], measures['b']
-            if self.n_a == 2 and self.n_b > 2 :
-                posterior['theta'][id, :] = [ np.sum(b[0]), np.sum(b[0, 1:]) ]
-                posterior['h'][id] = [ np.sum(b[0, 1:]), np.sum(b[0, 2:]), np.sum(b[1, 1:]), np.sum(b[1, 2:]) ]
-                posterior['v'][id] = [np.sum(b[1]), np.sum(b[1, 1:])]
-                posterior['v2'][id] = [np.sum(b[1]), np.sum(b[1, 1:])]
-            else :
-                posterior['theta'][id, :] = [ np.sum(b[0]), np.sum(b[0, 1:]) ]
-                posterior['h'][id] = [ np.sum(b[:2, 1:]), np.sum(b[:2, 2:]), np.sum(b[2:, 1:]), np.sum(b[2:, 2:]) ]
-                posterior['v'][id] = [ np.sum(b[1:2])+np.sum(b[3:]), np.sum(b[1:2, 1:])+np.sum(b[3:, 1:]) ]
-                posterior['v2'][id] = [ np.sum(b[2:3]), np.sum(b[2:3, 1:]) ]
-
-            posterior['R'][id, 0], posterior['R'][id, 1:a.shape[1]] = np.sum(a[0]), a[0, 1:]
-            posterior['delta'][id] = np.vstack([np.sum(a[1:], 1), a.T[0, 1:]]).T
-            posterior['probability'][id] = measures['probability']
-
-        prediction = copy.deepcopy(model)
+        # counts of all branches stacked into [n_branch, n_a, n_a] and [n_branch, n_a, n_b] arrays
+        a, b = np.zeros([len(branch_measures), self.n_a, self.n_a]), np.zeros([len(branch_measures), self.n_a, self.n_b])
+        active = np.array([ id not in self.frozen for id in range(len(branch_measures)) ], dtype=bool)
+        if np.any(active) :
+            a[active] = [ measures['a'] for measures, x in zip(branch_measures, active) if x ]
+            b[active] = [ measures['b'] for measures, x in zip(branch_measures, active) if x ]
+            posterior['probability'][active] = [ measures['probability'] for measures, x in zip(branch_measures, active) if x ]
+
+        posterior['theta'][:] = np.vstack([ np.sum(b[:, 0], 1), np.sum(b[:, 0, 1:], 1) ]).T
+        if self.n_a == 2 and self.n_b > 2 :
+            posterior['h'][:] = np.vstack([ np.sum(b[:, 0, 1:], 1), np.sum(b[:, 0, 2:], 1), np.sum(b[:, 1, 1:], 1), np.sum(b[:, 1, 2:], 1) ]).T
+            posterior['v'][:] = np.vstack([ np.sum(b[:, 1], 1), np.sum(b[:, 1, 1:], 1) ]).T
+            posterior['v2'][:] = posterior['v']
+        else :
+            posterior['h'][:] = np.vstack([ np.sum(b[:, :2, 1:], (1, 2)), np.sum(b[:, :2, 2:], (1, 2)), np.sum(b[:, 2:, 1:], (1, 2)), np.sum(b[:, 2:, 2:], (1, 2)) ]).T
+            posterior['v'][:] = np.vstack([ np.sum(b[:, 1:2], (1, 2))+np.sum(b[:, 3:], (1, 2)), np.sum(b[:, 1:2, 1:], (1, 2))+np.sum(b[:, 3:, 1:], (1, 2)) ]).T
+            posterior['v2'][:] = np.vstack([ np.sum(b[:, 2:3], (1, 2)), np.sum(b[:, 2:3, 1:], (1, 2)) ]).T
+        posterior['R'][:, 0], posterior['R'][:, 1:self.n_a] = np.sum(a[:, 0], 1), a[:, 0, 1:]
+        posterior['delta'][:] = np.stack([ np.sum(a[:, 1:], 2), a[:, 1:, 0] ], 2)
+
+        for id, row in self.frozen.items() :
+            # unchanged branch in an update, its saved posterior is kept
+            for k, v in row.items() :
+                posterior[k][id] = v
+
+        prediction = model.copy()
         prediction['posterior'] = posterior
         prediction['probability'] = np.sum(posterior['probability'])
 
@@ -309,191 +1144,127 @@ class recHMM(object) :
         prediction['EventFreq'] = np.sum(EventFreq, 1)
         prediction['h'] = [np.sum(posterior['h'].T[1])/np.sum(posterior['h'].T[0]), 0.0 if np.sum(posterior['h'].T[2]) == 0 else np.sum(posterior['h'].T[3])/np.sum(posterior['h'].T[2])]
 
-        for id, theta in enumerate(prediction['theta']) :
-            ids = (model['categories']['R/theta'] == id)
-            prediction['theta'][id] = np.sum(EventFreq[ids, 0]/prediction['EventFreq'][ids])
-            prediction['R'][id] = np.sum(EventFreq[ids, 1:].T/prediction['EventFreq'][ids], 1)[:prediction['R'][id].size]
-            if np.sum(prediction['R'][id]) < .001 * prediction['theta'][id] :
-                prediction['theta'][id] = np.sum(prediction['R'][id])/.001
-            tot_event = (prediction['theta'][id]+np.sum(prediction['R'][id]))
-            prediction['theta'][id] = prediction['theta'][id]/tot_event
-            prediction['R'][id] = prediction['R'][id]/tot_event
-
-        for id, delta in enumerate(prediction['delta']) :
-            ids = (model['categories']['delta'] == id)
-            
-            delta_sum = [np.sum(posterior['delta'][ids, :, 1]), np.sum(posterior['delta'][ids, :, 0])]
-            delta_sum2 = [np.sum(posterior['delta'][ids, 1, 1]), np.sum(posterior['delta'][ids, 1, 0])]
-            delta_sum = [delta_sum[0] - delta_sum2[0], delta_sum[1] - delta_sum2[1]]
-
-            prediction['delta2'][id] = delta_sum2[0]/delta_sum2[1]
-            prediction['delta2'][id] = min(max(prediction['delta2'][id], .00001), .05)
-
-            prediction['delta'][id] = delta_sum[0]/delta_sum[1]
-            prediction['delta'][id] = min(max(prediction['delta'][id], .00001), .05)
-
-        for id, v in enumerate(prediction['v']) :
-            ids = (model['categories']['nu'] == id)
-            if np.sum(posterior['v'][ids, 0]) > 0 :
-                prediction['v'][id] = np.sum(posterior['v'][ids, 1])/np.sum(posterior['v'][ids, 0])
-            if np.sum(posterior['v2'][ids, 0]) > 0 :
-                prediction['v2'][id] = np.sum(posterior['v2'][ids, 1])/np.sum(posterior['v2'][ids, 0])
-
-            prediction['v'][id] = min(max( prediction['v'][id], 0.0001 ), 0.7)
-            prediction['v2'][id] = min(max( prediction['v2'][id], 0.0001 ), 0.7)
+        # per-category sums over branches, as weighted bincounts
+        group = lambda cats, weights, n : np.bincount(cats, weights=weights, minlength=n)[:n]
+        cats, n = model['categories']['R/theta'], prediction['theta'].size
+        theta = group(cats, EventFreq[:, 0]/prediction['EventFreq'], n)
+        R = np.array([ group(cats, w, n) for w in EventFreq[:, 1:].T/prediction['EventFreq'] ]).T[:, :prediction['R'].shape[1]]
+        low = np.sum(R, 1) < .001 * theta
+        theta[low] = np.sum(R[low], 1)/.001
+        tot_event = theta + np.sum(R, 1)
+        prediction['theta'], prediction['R'] = theta/tot_event, R/tot_event[:, np.newaxis]
+
+        cats, n, delta = model['categories']['delta'], len(prediction['delta']), posterior['delta']
+        delta_sum = [ group(cats, np.sum(delta[:, :, 1], 1), n), group(cats, np.sum(delta[:, :, 0], 1), n) ]
+        delta_sum2 = [ group(cats, delta[:, 1, 1], n), group(cats, delta[:, 1, 0], n) ]
+        delta_sum = [ delta_sum[0] - delta_sum2[0], delta_sum[1] - delta_sum2[1] ]
+        prediction['delta2'] = np.clip(delta_sum2[0]/delta_sum2[1], .00001, .05)
+        prediction['delta'] = np.clip(delta_sum[0]/delta_sum[1], .00001, .05)
+
+        cats, n = model['categories']['nu'], len(prediction['v'])
+        for k in ('v', 'v2') :
+            total, hit = group(cats, posterior[k][:, 0], n), group(cats, posterior[k][:, 1], n)
+            prediction[k] = np.where(total > 0, hit/np.where(total > 0, total, 1.), np.asarray(prediction[k], dtype=float))
+            prediction[k] = np.clip(prediction[k], 0.0001, 0.7)
         return prediction
 
     def update_branch_parameters(self, model, lower_limit=False) :
-        branch_params = []
-
-        for brId, d in enumerate(model['EventFreq']) :
-            rId, dId, vId = model['categories']['R/theta'][brId], model['categories']['delta'][brId], model['categories']['nu'][brId]
-            if lower_limit and d < .5/self.n_base:
-                d = .5/self.n_base
-            m, r = min(d * model['theta'][rId], 0.74), (d * model['R'][rId])
-            if np.sum(r) > 0.74 :
-                r[r > 0.25] = 0.25
-
-            a = np.zeros(shape=[self.n_a, self.n_a])
-            a[0, 1:] = r
-            a[1:, 0] = model['delta'][dId]
-            if self.n_a > 2 :
-                a[2, 0] = model['delta2'][dId]
-            if brId in model['categories'].get('noRec', {}) :
-                m += np.sum(r)
-                a[0, 1:] = 1e-300
-                a[1:, 0] = 1-1e-6
-
-            np.fill_diagonal(a, 1-np.sum(a, 1))
-            b = np.zeros(shape=[self.n_a, self.n_b])
-            h = [(1-model['h'][0]), model['h'][0]]
-            h2 = [(1-model['h'][1]), model['h'][1]]
-
-            v, v2 = model['v'][vId], model['v2'][vId]
-
-            b[0]  = [ 1-m ] + [m * hh for hh in h][:self.n_b-1]
-            extra = [ 1-v ] + [v * hh for hh in h][:self.n_b-1]
-            intra = [ 1-v2 ] + [v2 * hh for hh in h2][:self.n_b-1]
-            mixed = [ 1-v ] + [v * hh for hh in h2][:self.n_b-1]
-            b[1] = intra if self.n_a == 2 and self.n_b > 2 else extra
-
-            if self.n_a > 2 :
-                b[2] = intra
-                if self.n_a > 3 :
-                    b[3] = mixed
-            b[b.T[0] < 0.01, 0] = 0.01
-            if b.shape[1] > 2 :
-                b[2:, 1] = 1 - b[2:, 0] - b[2:, 2]
-
-            branch_params.append(dict(
-                pi = np.array([1.] + [0. for i in range(1, self.n_a)]),
-                a = a,
-                b = b,
-            ))
-        return branch_params
-
-    def iter_branch_measure(self, data) :
-        obs, param, gammaOnly = data
-        interval = np.max([np.max(o.T[4]) for o in obs] + [50])
-        dist_transition = np.zeros(shape=[interval, param['a'].shape[0], param['a'].shape[1]] )
-        dist_transition_adj = np.zeros(shape=[interval] )
-        
-        a2, a2x, saturate_id = update_distant_transition( param['a'], param['b'].T, dist_transition, dist_transition_adj )
-        new_params = []
-        for o in obs :
-            alpha_Pr, alpha, beta = self.forward_backward(o, pi=param['pi'], a2s=[a2, a2x], b=param['b'])
-            new_param = self.estimate_params(param['a'], param['b'], o, alpha, beta, a2, saturate_id, gammaOnly)
-            new_param['probability'] = alpha_Pr
-            new_params.append(new_param)
-        new_param = {'a':[], 'b':[], 'probability':[], 'gamma':[]}
-        for k in new_param :
-            new_param[k] = np.sum(np.array([ p.get(k) for p in new_params if k in p ]), 0) if k != 'gamma' \
-                else [p.get(k) for p in new_params if k in p]
-        
-        return new_param
+        # initial, transition and emission probabilities of all branches, as [n_branch, n_a],
+        # [n_branch, n_a, n_a] and [n_branch, n_a, n_b] tensors
+        categories = model['categories']
+        rId, dId, vId = np.asarray(categories['R/theta']), np.asarray(categories['delta']), np.asarray(categories['nu'])
+        d = np.asarray(model['EventFreq'], dtype=float)
+        if lower_limit :
+            d = np.maximum(d, .5/self.n_base)
+        m, r = np.minimum(d * np.asarray(model['theta'])[rId], 0.74), d[:, np.newaxis] * np.asarray(model['R'])[rId]
+        r[(np.sum(r, 1) > 0.74)[:, np.newaxis] & (r > 0.25)] = 0.25
+        noRec = np.zeros(d.size, dtype=bool)
+        noRec[list(categories.get('noRec', {}))] = True
+
+        a = np.zeros(shape=[d.size, self.n_a, self.n_a])
+        a[:, 0, 1:] = r
+        a[:, 1:, 0] = np.asarray(model['delta'])[dId][:, np.newaxis]
+        if self.n_a > 2 :
+            a[:, 2, 0] = np.asarray(model['delta2'])[dId]
+        m[noRec] += np.sum(r[noRec], 1)
+        a[noRec, 0, 1:] = 1e-300
+        a[noRec, 1:, 0] = 1-1e-6
+        diag = np.arange(self.n_a)
+        a[:, diag, diag] = 1-np.sum(a, 2)
+
+        emission = lambda p, hh : np.stack([ 1-p, p * (1-hh), p * hh ], 1)[:, :self.n_b]
+        v, v2 = np.asarray(model['v'])[vId], np.asarray(model['v2'])[vId]
+        b = np.zeros(shape=[d.size, self.n_a, self.n_b])
+        b[:, 0] = emission(m, model['h'][0])
+        extra, intra, mixed = emission(v, model['h'][0]), emission(v2, model['h'][1]), emission(v, model['h'][1])
+        b[:, 1] = intra if self.n_a == 2 and self.n_b > 2 else extra
+        if self.n_a > 2 :
+            b[:, 2] = intra
+            if self.n_a > 3 :
+                b[:, 3] = mixed
+        b[:, :, 0] = np.maximum(b[:, :, 0], 0.01)
+        if self.n_b > 2 :
+            b[:, 2:, 1] = 1 - b[:, 2:, 0] - b[:, 2:, 2]
 
-    def get_branch_measures(self, params, observations, gammaOnly=False) :
-        branch_measures = pool.map(functools.partial(_iter_branch_measure, self), zip(observations, params, [gammaOnly for p in params]))
-        return branch_measures
+        pi = np.zeros(shape=[d.size, self.n_a])
+        pi[:, 0] = 1.
+        return dict(pi=pi, a=a, b=b)
 
-    def estimate_params(self, transition, emission, obs, alpha, beta, tr2, saturate_id, gammaOnly=False) : # mode = accurate
-        n_a, n_b = self.n_a, self.n_b
-        gamma = alpha*beta
-        gamma = (gamma.T/np.sum(gamma, 1)).T
-    
-        na = np.dot(alpha[0], tr2[saturate_id])*emission.T[0]
-        nb = np.dot(beta[0], tr2[saturate_id].T)
-        ng = na*nb/np.sum(na*nb)
-        ne = np.array([na for i in range(n_a)]).T * np.array([nb*emission.T[0] for i in range(n_a)])*transition
-        ne /= np.sum(ne)
-    
-        a2 = np.zeros(shape=[n_a, n_a])
-        b2 = np.zeros(shape=[n_a, n_b])
-    
-        for o, g in zip(obs, gamma) :
-            b2[:, o[3]] += g
-        
-        for o, s, e in zip(obs[1:], alpha[:-1], beta[1:]) :
-            d = o[4] - 1
-            if d > 2*saturate_id :
-                a2 += (d - 2*saturate_id)*ne
-                b2[:, 0] += (d - 2*saturate_id)*ng
-                d = 2 * saturate_id
-    
-            if d > saturate_id :
-                a, b = np.zeros(shape=[2, d, n_a])
-                a[:], b[:] = na, nb
-                a[:saturate_id] = np.dot(s, tr2[:saturate_id])*emission.T[0]
-                b[-saturate_id:] = np.dot(e*emission.T[o[3]], tr2[:saturate_id].transpose((0, 2, 1)))[::-1]
-            else :
-                a = np.dot(s, tr2[:d])*emission.T[0]
-                b = np.dot(e*emission.T[o[3]], tr2[:d].transpose((0, 2, 1)))[::-1]
-    
-            g = a*b
-            g = g.T/np.sum(g, 1)
-    
-            b2[:, 0] += np.sum(g, 1)
-            if not gammaOnly :
-                s1 = np.zeros(shape=[d+1, n_a, 1])
-                s1[0, :, 0] = s
-                s1[1:, :, 0] = a
-            
-                s2 = np.zeros(shape=[d+1, 1, n_a])
-                s2[:-1, 0, :] = (b*emission.T[0])
-                s2[-1, 0, :] = e*emission.T[o[3]]
-    
-                t = np.matmul(s1, s2) * transition.reshape([1] + list(transition.shape))
-                a2 += np.sum(t.T/np.sum(t, axis=(1,2)), 2).T
-    
-        a2[0] += gamma[0]
-        a2.T[0] += gamma[-1]
+    def iter_block_measure(self, data) :
+        brId, blkIds, (pi, transition, emission), gammaOnly, interval = data
+        obs, bounds = self.observations.segment(brId, blkIds[0], blkIds[-1])
+        a2, a2x, saturate_id, slope = distant_transition(transition, emission, interval)
+        probability, a, b, gamma = measure_blocks(pi, transition, emission, a2, a2x, slope, saturate_id, obs.state, obs.gap, bounds, gammaOnly)
         if gammaOnly :
-            return dict(b=b2, gamma=gamma)
-        else :
-            return dict(a=a2, b=b2)
-
-    def forward_backward(self, obs, pi, a2s, b) :
-        bv = b.T
-        a2, a2x = a2s
-        alpha, alpha_Pr = np.zeros(shape=[obs.shape[0], self.n_a]), 0.
-        alpha[0] = np.dot(pi, a2[0]) * bv[obs[0, 3]]
-        alpha_Pr = np.sum(alpha[0])
-        alpha[0], alpha_Pr = alpha[0]/alpha_Pr, np.log(alpha_Pr)
-        for id, o in enumerate(obs[1:]) :
-            r = np.dot(alpha[id], a2[o[4]-1]) * bv[o[3]]
-            s = np.sum(r)
-            alpha[id+1] = r/s
-            alpha_Pr += np.log(s) + a2x[o[4]-1]
-
-        beta, beta_Pr = np.ones(shape=[obs.shape[0], self.n_a]), 0.
-        beta[-1] = np.dot(pi, a2[0].T)
-        for i, o in enumerate(obs[:0:-1]) :
-            id = obs.shape[0]-1-i
-            r = np.dot(beta[id] * bv[o[3]], a2[o[4]-1].T)
-            s = np.sum(r)
-            beta[id-1] = r/s
-            beta_Pr += np.log(s) + a2x[o[4]-1]
-        return alpha_Pr, alpha, beta
+            # gamma is reduced here to the observations whose most likely state is not 0 and P(state 0) < 0.5:
+            # their numbers per block, indices within the block, states and 1-P(state 0)
+            p = np.argmax(gamma, 1)
+            ids = np.flatnonzero((p > 0) & (gamma[:, 0] < 0.5))
+            counts = np.diff(np.searchsorted(ids, bounds))
+            return dict(b=b, calls=(counts, ids - np.repeat(bounds[:-1], counts), p[ids], 1-gamma[ids, 0]), probability=probability)
+        return dict(a=a, b=b, probability=probability)
+
+    def get_model_measures(self, model_params, skip=()) :
+        # E-steps of several models in one batch
+        model_measures = []
+        for block_measures in self.engine.measure(model_params, skip) :
+            branch_measures = []
+            for new_params in block_measures :
+                new_param = {'a':[], 'b':[], 'probability':[]}
+                for k in new_param :
+                    new_param[k] = np.sum(np.array([ p.get(k) for p in new_params if k in p ]), 0)
+                branch_measures.append(new_param)
+            model_measures.append(branch_measures)
+        return model_measures
+
+    def prepare(self, mutations, sequences, missing) :
+        # fit() followed by predict() on the same data keeps the observations and the workers
+        if self.prepared is not mutations :
+            self.observations = self.load_observations(mutations, sequences, missing)
+            self.prepared = mutations
+            if self.engine :
+                self.engine.close()
+            self.engine = BlockEngine(self, self.n_proc, self.pool)
+        return self.observations
+
+    def load_observations(self, mutations, sequences, missing) :
+        # prepared observations are kept in the cache folder, keyed by a hash of the input
+        if not self.cache :
+            return ObservationStore(self.prepare_branches(mutations, sequences, missing, interval=None))
+        key = hashlib.sha1(repr((_cache_version, self.n_a, self.n_b, [[str(n), int(l)] for n, l in sequences])).encode())
+        for x in (mutations, missing) :
+            x = np.ascontiguousarray(x)
+            key.update(repr((x.shape, x.dtype.str)).encode())
+            key.update(x.tobytes())
+        fname = os.path.join(self.cache, 'RecHMM.{0}.obs.npy'.format(key.hexdigest()[:20]))
+        if os.path.isfile(fname + '.idx.npz') :
+            store, info = ObservationStore.load(fname)
+            if store is not None :
+                self.n_base = int(info['n_base'])
+                return store
+        if not os.path.isdir(self.cache) :
+            os.makedirs(self.cache)
+        return ObservationStore(self.prepare_branches(mutations, sequences, missing, interval=None), fname=fname, n_base=self.n_base)
 
     def get_brLens(self, branches, n_base) :
         return np.array([ np.sum(branch.T[1] > 0)/float(n_base) for branch in branches ])
@@ -505,50 +1276,39 @@ class recHMM(object) :
         branches = np.unique(mutations.T[0])
         mutations = np.hstack([mutations, np.zeros([mutations.shape[0], 2], dtype=int)])
         blocks = []
-        
+        # rows, blocks and missing regions are grouped by sequence, and each sequence takes a slice
+        seqIds = np.arange(len(sequences)+1)
+        if missing.size :
+            missing = missing[np.argsort(missing.T[0], kind='stable')]
+            ms_bounds = np.searchsorted(missing.T[0], seqIds)
+
         for seqId, (seqName, seqLen) in enumerate(sequences) :
             region = [[seqId, 1, seqLen]]
             if missing.size :
-                for ms in missing[(missing.T[0] == seqId) & (missing.T[2] - missing.T[1] + 1 >= np.min([500, seqLen]))] :
+                seq_missing = missing[ms_bounds[seqId]:ms_bounds[seqId+1]]
+                for ms in seq_missing[seq_missing.T[2] - seq_missing.T[1] + 1 >= np.min([500, seqLen])] :
                     region[-1][2] = ms[1] - 1
                     region.append([seqId, ms[2]+1, seqLen])
             region = [ (r[0], r[1], r[2], r[2]-r[1]+1, 0) for r in region if r[2]>=r[1] ]
             blocks.extend(region)
         blocks = np.array(blocks, dtype=int)
         blocks.T[4] = np.arange(blocks.shape[0])
-        anchors = [np.vstack([ np.vstack([branches, np.repeat(block[0], branches.size), np.repeat(block[1]-1, branches.size), np.zeros([3, branches.size])]).T, 
-                               np.vstack([branches, np.repeat(block[0], branches.size), np.repeat(block[2]+1, branches.size), np.zeros([3, branches.size])]).T ] ) for block in blocks]
-        mutations = np.vstack([mutations] + anchors).astype(int)
+        anchors = np.zeros([2 * blocks.shape[0] * branches.size, 6], dtype=int)
+        anchors.T[0] = np.tile(branches, 2 * blocks.shape[0])
+        anchors.T[1] = np.repeat(blocks.T[0], 2 * branches.size)
+        anchors.T[2] = np.repeat(np.vstack([blocks.T[1]-1, blocks.T[2]+1]).T.ravel(), branches.size)
+        mutations = np.vstack([mutations, anchors]).astype(int)
         mutations = mutations[np.lexsort(mutations.T[::-1])]
-        self.n_base = 0
+        mutations = mutations[np.argsort(mutations.T[1], kind='stable')]
+        mut_bounds, blk_bounds = np.searchsorted(mutations.T[1], seqIds), np.searchsorted(blocks.T[0], seqIds)
+        self.n_base, extra = 0, []
         for seqId, (seqName, seqLen) in enumerate(sequences) :
-            regions = blocks[blocks.T[0] == seqId]
+            regions = blocks[blk_bounds[seqId]:blk_bounds[seqId+1]]
             if regions.shape[0] == 0 : continue
-            s = np.zeros([2, seqLen+2], dtype=int)
-            s[1] = np.arange(seqLen+2)
-            if missing.size :
-                for ms in missing[(missing.T[0] == seqId)] :
-                    s[1, ms[1]:ms[2]+1] = -2
-                    s[1, ms[2]+1:] -= ms[2]-ms[1]+1
-            for r in regions :
-                if r[4] == 55 :
-                    print ('')
-                s[0, r[1]-1:r[2]+2] = r[4]
-                if s[1, r[1]] > 1 :
-                    s[1, r[1]-1] = s[1, r[1]] - 1
-                else :
-                    ss = s[1, r[1]:r[2]+1]
-                    s[1, r[2]+1] = np.min(ss[ss>0]) - 1
-                s[1, r[1]-1:r[2]+1] -= s[1, r[1]-1]
-                if s[1, r[2]] > 0 :
-                    s[1, r[2]+1] = s[1, r[2]] + 1
-                else :
-                    s[1, r[2]+1] = np.max(s[1, r[1]:r[2]+1]) + 1
-                
-                r[3] = np.sum(s[1, r[1]:r[2]+1]>0)
-            self.n_base += int(np.sum(s[1] >= 0))
-            mutations[mutations.T[1] == seqId, -2:] = s.T[mutations[mutations.T[1] == seqId, 2]]
-            mut = np.copy(mutations[(mutations.T[1] == seqId)]).astype(float)
+            seq_mut = mutations[mut_bounds[seqId]:mut_bounds[seqId+1]]
+            n_base, seq_mut[:, -2:] = compress_coordinates(seqLen, regions, missing[ms_bounds[seqId]:ms_bounds[seqId+1], 1:] if missing.size else [], seq_mut[:, 2])
+            self.n_base += n_base
+            mut = seq_mut.astype(float)
             mut.T[2] = 0
             mut[:-1, 2] = mut[1:, 5] - mut[:-1, 5]
             anchors = mut[:-1][(mut[:-1, 2] > interval) & (mut[:-1, 3]+mut[1:, 3] > 0)]
@@ -558,9 +1318,10 @@ class recHMM(object) :
             while anchors.size :
                 anchors.T[5] += anchors.T[1]
                 mutAnchors = np.vstack([anchors.T[0], np.repeat(seqId, anchors.shape[0]), np.repeat(-1, anchors.shape[0]), np.zeros(anchors.shape[0]), anchors.T[4], np.round(anchors.T[5])]).T.astype(int)
-                mutations = np.vstack([mutations, mutAnchors])
+                extra.append(mutAnchors)
                 anchors.T[3] -= 1
                 anchors = anchors[anchors.T[3] > 0]
+        mutations = np.vstack([mutations] + extra)
         mutations = mutations[np.lexsort(mutations.T[[5, 4, 0]])]
         mutations[mutations.T[2] == 0, 2] = 1
         mutations[mutations.T[2] > blocks[mutations.T[4], 2], 2] -= 1
@@ -573,140 +1334,114 @@ class recHMM(object) :
         else :
             mutations[mutations.T[3] > 1, 3] = 1
         
-        def prepare_obs(obs, blocks, interval=None) :
-            res = [ obs[obs.T[4] == blkId] for blkId, block in enumerate(blocks) ]
+        # every branch has the two anchors of every block, so rows split into branch x block groups
+        groups = np.split(mutations, np.flatnonzero(np.any(np.diff(mutations[:, [0, 4]], axis=0) != 0, 1)) + 1)
+        def prepare_obs(res) :
             for i, r in enumerate(res) :
                 if r[-1, 2] == r[-2, 2] :
                     res[i] = r[:-1]
                     r = res[i]
                 r[1:, 4] = np.diff(r.T[5])
             return res
-        return [prepare_obs(mutations[mutations.T[0] == brId], blocks, interval) for brId in np.unique(mutations.T[0])]
+        return [prepare_obs(groups[i:i+blocks.shape[0]]) for i in range(0, len(groups), blocks.shape[0])]
 
     def predict(self, mutations, branches, sequences, missing, marginal, tree=None) :
         prefix = self.prefix
         assert self.model, 'No model'
-        self.observations = self.prepare_branches(mutations, sequences, missing, interval=None)
+        self.prepare(mutations, sequences, missing)
         self.branches = branches if branches is not None else np.arange(len(self.observations)).astype(str)
         self.sequences = sequences if sequences is not None else [[str(id), 0] for id, _ in enumerate(self.observations[0])]
 
         stats = self.margin_predict(marginal) if marginal > 0. and marginal <= 1. else self.map_predict()
         
+        # branches are written as their sketches come in. The imported regions are also returned, in the
+        # form DivHMM reads from the file, with the mutation rates for the tree
+        importations, rates = {}, {}
         with open(prefix+'.recombination.region', 'w') as rec_out:
             rec_out.write('#Branch\tname\tmutationRate\trecombinationRate\tMutationCoverage\n')
             rec_out.write('#\tImportation\tseqName\tstart\tend\ttype\tscore\n')
-            for name in self.branches :
-                stat = stats[name]
-                m2 = -3./4.*np.log(1-4./3.*stat['M'])
+            for name, stat in stats :
+                rates[name] = m2 = -3./4.*np.log(1-4./3.*stat['M'])
                 rec_out.write('Branch\t{0}\tM={1:.5e}\tR={2:.5e}\tB={3:.3f}\n'.format(name, m2, stat['R'], stat['weight_p'][0]))
                 for r in stat['sketches'] :
                     rec_out.write('\tImportation\t{0}\t{1}\t{2}\t{3}\t{4}\t{5:.3f}\n'.format(name, self.sequences[r[0]][0], r[1], r[2], ['External', 'Internal', 'Mixed   '][r[3]-1], r[4]))
+                    importations.setdefault(str(name), {}).setdefault(self.sequences[r[0]][0], []).append([int(r[1]), int(r[2])])
         if tree :
             from ete3 import Tree
             tre = Tree(tree, format=1)
             for node in tre.traverse() :
-                if node.name in stats :
-                    node.dist = -3./4.*np.log(1-4./3.*stats[node.name]['M'])
+                if node.name in rates :
+                    node.dist = rates[node.name]
                 else :
                     node.dist = 1e-8
             tre.write(format=1, outfile=prefix + '.mutational.tre')
             print('Mutational tree is written in {0}'.format(prefix+'.mutational.tre'))
 
         print('Imported regions are reported in {0}'.format(prefix+'.recombination.region'))
+        return importations
 
     def map_predict(self) :
         self.screen_out('Predict recombination sketches using', self.model)
         branch_params = self.update_branch_parameters(self.model, lower_limit=True)
-        status = pool.map(functools.partial(_iter_viterbi, self), zip(self.observations, branch_params))
-        #status = list(map(functools.partial(_iter_viterbi, self), zip(self.observations, branch_params)))
-        res = {}
-        for name, dm, dr, stat in zip(self.branches, self.model['posterior']['theta'], self.model['posterior']['R'], status) :
+        for brId, block_runs in self.engine.viterbi(branch_params) :
+            stat = self.viterbi(block_runs)
+            dm, dr = self.model['posterior']['theta'][brId], self.model['posterior']['R'][brId]
             rec_len = np.sum([ e1-s1+1 for c, s, e, t, s1, e1, p in stat['sketches'] ])
-            res[name] = dict(sketches=[ k[:4]+k[6:] for k in stat['sketches']],
+            yield self.branches[brId], dict(sketches=[ k[:4]+k[6:] for k in stat['sketches']],
                              weight_p=np.array([self.n_base-rec_len, rec_len], dtype=float),
                              M=dm[1]/dm[0],
                              R=np.sum(dr[1:])/dr[0])
-        return res
 
     def margin_predict(self, marginal=0.9) :
+        # the workers return only the calls of each block; the paths are chained here, in order, as a
+        # path may carry on into the next block
         branch_params = self.update_branch_parameters(self.model, lower_limit=True)
-        status = self.get_branch_measures(branch_params, self.observations, gammaOnly=True)
-        res = {}
-        for name, dm, dr, observation, stat in zip(self.branches, self.model['posterior']['theta'], self.model['posterior']['R'], self.observations, status) :
-            path = []
-            for obs, gamma in zip(observation, stat['gamma']) :
-                for id, (o, s) in enumerate(zip(obs, gamma)) :
-                    p = np.argmax(s)
-                    if p > 0 and s[0] < 0.5 :
-                        if len(path) == 0 or path[-1][3] != p or path[-1][5] != obs[id-1][5] :
-                            if o[2] >= 0 :
-                                path.append([o[1], o[2], o[2], p, o[5], o[5], 1-s[0]])
-                        else :
-                            path[-1][5] = o[5]
-                            if 1-s[0] > path[-1][6] :
-                                path[-1][6] = 1-s[0]
-                            if o[2] >= 0 :
-                                path[-1][2] = o[2]
-            res[name] = dict(sketches=[p[:4]+p[6:] for p in path if p[2]-p[1] > 0 and p[6] >= marginal],
-                             weight_p=np.sum(stat['b'], 1),
+        for brId, block_measures in self.engine.marginal(branch_params) :
+            dm, dr = self.model['posterior']['theta'][brId], self.model['posterior']['R'][brId]
+            path, calls = [], [ zip(*[ np.split(x, np.cumsum(m['calls'][0])[:-1]) for x in m['calls'][1:] ]) for m in block_measures ]
+            for obs, (ids, states, scores) in zip(self.observations[brId], [ c for task_calls in calls for c in task_calls ]) :
+                for id, p, score in zip(ids, states, scores) :
+                    site, pos = obs.site[id], obs.pos[id]
+                    if len(path) == 0 or path[-1][3] != p or path[-1][5] != obs.pos[id-1] :
+                        if site >= 0 :
+                            path.append([obs.seq, site, site, p, pos, pos, score])
+                    else :
+                        path[-1][5] = pos
+                        if score > path[-1][6] :
+                            path[-1][6] = score
+                        if site >= 0 :
+                            path[-1][2] = site
+            yield self.branches[brId], dict(sketches=[p[:4]+p[6:] for p in path if p[2]-p[1] > 0 and p[6] >= marginal],
+                             weight_p=np.sum(np.sum([ m['b'] for m in block_measures ], 0), 1),
                              M=dm[1]/dm[0],
                              R=np.sum(dr[1:])/dr[0])
-        return res
 
 
-    def viterbi(self, data) :
-        observation,  params = data
-        pi, a, b = params['pi'], params['a'], params['b']
-        bv = b.T
+    def block_viterbi(self, data) :
+        brId, blkId, (pi, a, b) = data
+        obs = self.observations[brId][blkId]
+        a, b = np.where(a == 0, 1e-300, a), np.where(b == 0, 1e-300, b)
+        pa, pb = np.log(a), np.log(b)
+        rsite = dict(zip(obs.pos, obs.site))
+        sites = np.unique(obs.pos)
+        runs = sparse_viterbi(pa, pb, np.log(np.dot(pi, a)), np.log(np.dot(pi, a.T)), obs.state, obs.gap, obs.pos)
+        return obs.seq, [ (lo, hi, max_path, [ rsite[id] for id in sites[np.searchsorted(sites, lo):np.searchsorted(sites, hi, 'right')][::-1] ]) \
+                            for lo, hi, max_path in runs ]
+
+    def viterbi(self, block_runs) :
+        # merges the runs of consecutive blocks into regions
         regions = []
-        for obs in observation :
-            rsite = dict(obs[:, np.array([5,2])])
-            seqName, n_base = obs[0, 1], obs[-1, -1] + 1
-            path = np.zeros(shape=[n_base, self.n_a], dtype=int)
-            alpha = np.zeros(shape=[n_base, self.n_a])
-            alpha[0] = np.log( np.dot(pi, a) * bv[obs[0, 3]])
-    
-            i = 0
-            p = np.zeros([self.n_a, self.n_a])
-            a[a==0], b[b==0] = 1e-300, 1e-300
-            
-            pa, pb = np.log(a), np.log(b)
-            ids = np.arange(self.n_a)
-            for br, sn, s0, o, d, s in obs[1:] :
-                for dd in np.arange(d-1) :
-                    i += 1
-                    p.T[:] = alpha[i-1]
-                    p = p + pa + pb.T[0]
-                    path[i] = np.argmax(p, 0)
-                    alpha[i] = p[path[i], ids]
-                    if np.max(path[i]) == 0 :
-                        j = i + d - 1 - dd
-                        alpha[i:j] = alpha[i]
-                        alpha[i:j] += ((pa[0, 0] + pb[0, 0]) * np.arange(d-1-dd)).reshape(d-1-dd, 1)
-                        i = j - 1
-                        break
-                i += 1
-                p.T[:] = alpha[i-1]
-                p = p + pa + pb.T[o]
-                path[i] = np.argmax(p, 0)
-                alpha[i] = p[path[i], ids]
-            alpha[i] += np.log( np.dot(pi, a.T) )
-            max_path = np.argmax(alpha[i])
-            inrec = np.zeros(path.shape[0])
-            for id in np.arange(path.shape[0]-2, 0, -1) :
-                max_path = path[id+1, max_path]
-                if max_path > 0 :
-                    inrec[id] = 1
-                    if len(regions) == 0 or regions[-1][4] != id + 1 :
-                        regions.append([seqName, -1, -1, max_path, id, id, 1.])
-                    else :
-                        regions[-1][4] = id
-                    if id in rsite :
-                        if regions[-1][2] == -1 :
-                            regions[-1][2] = rsite[id]
-                        regions[-1][1] = rsite[id]
+        for seqName, runs in block_runs :
+            for lo, hi, max_path, rsites in runs :
+                if len(regions) == 0 or regions[-1][4] != hi + 1 :
+                    regions.append([seqName, -1, -1, max_path, hi, hi, 1.])
+                regions[-1][4] = lo
+                for site in rsites :
+                    if regions[-1][2] == -1 :
+                        regions[-1][2] = site
+                    regions[-1][1] = site
         regions = [r for r in regions if r[2] >= 0]
-        return dict(sketches=sorted(regions), gamma=1.-inrec[ obs.T[5] ])
+        return dict(sketches=sorted(regions))
 
     def report(self, bootstrap) :
         prefix = self.prefix
@@ -784,53 +1519,90 @@ def parse_arg(a) :
     parser.add_argument('--marginal', '-M', help='Find recombinant regions using marginal likelihood rather than [DEFAULT] maximum likelihood method. \n[DEFAULT] 0 to use Viterbi algorithm to find most likely path.\n Otherwise (0, 1) use forward-backward algorithm, and report regions with >= M posterior likelihoods as recombinant sketches.', default=0, type=float)
     parser.add_argument('--tree', '-T', help='[INPUT, OPTIONAL] A labelled tree. Only used to generate corresponding mutational tree.', default=None)
     parser.add_argument('--clean', '-v', help='Do not show intermediate results during the iterations.', default=False, action='store_true')
+    parser.add_argument('--update', '-u', help='Update the model given by --model with the data, which may hold new branches. Starts from the saved parameters, and\nbranches whose mutations did not change keep their saved posteriors unless these shift.', default=False, action='store_true')
+    parser.add_argument('--resume', '-s', help='Continue an interrupted fit from <prefix>.rec.checkpoint.pkl, which is updated after every iteration.', default=False, action='store_true')
+    parser.add_argument('--accelerate', '-a', help='Extrapolate the global parameters every few EM iterations (SQUAREM). Steps that reduce the likelihood fall back to the plain EM update.', default=False, action='store_true')
+    parser.add_argument('--cache', '-C', help='Folder that keeps the prepared observations, which later runs on the same data map directly. Default: the folder of --prefix. ', default=None)
+    parser.add_argument('--no_cache', help='Do not keep the prepared observations. ', default=False, action='store_true')
+    parser.add_argument('--json', '-J', help='Save the model as JSON (<prefix>.best.model.json) rather than in the binary format (<prefix>.best.model.npz). \n--model reads either. ', default=False, action='store_true')
     parser.add_argument('--local_r', '-lr', help='Specify a comma-delimited list of branches that share a different R/theta (Frequency of rec) ratio than the global consensus. Can be specified multiple times. \nUse "*" to assign different value for each branch.', default=[], action="append")
     parser.add_argument('--local_nu', '-ln', help='Specify a comma-delimited list of branches that share a different Nu (SNP density in rec) than the global consensus. Can be specified multiple times. \nUse "*" to assign different value for each branch.', default=[], action="append")
     parser.add_argument('--local_delta', '-ld', help='Specify a comma-delimited list of branches that share a different Delta (Length of rec sketches) than the global consensus. Can be specified multiple times. \nUse "*" to assign different value for each branch.', default=[], action="append")
 
     args = parser.parse_args(a)
-    args.categories = { 'R/theta':{},
-                        'nu':{},
-                        'delta':{} }
-    for variable, categories in zip(['R/theta', 'nu', 'delta'], [args.local_r, args.local_nu, args.local_delta]) :
-        for id, category in enumerate(categories) :
-            branches = category.split(',')
-            args.categories[variable].update({ br:id+1 for br in branches })
-        if '*' in args.categories[variable] :
-            args.categories[variable] = {'*': 0}
+    if args.update and not args.model :
+        parser.error('--update needs a saved model from --model')
+    args.categories = parse_categories(args.local_r, args.local_nu, args.local_delta)
     return args
 
 
-def read_data_file(data_file) :
+def parse_categories(local_r, local_nu, local_delta) :
+    categories = { 'R/theta':{},
+                   'nu':{},
+                   'delta':{} }
+    for variable, assigns in zip(['R/theta', 'nu', 'delta'], [local_r, local_nu, local_delta]) :
+        for id, category in enumerate(assigns) :
+            branches = category.split(',')
+            categories[variable].update({ br:id+1 for br in branches })
+        if '*' in categories[variable] :
+            categories[variable] = {'*': 0}
+    return categories
+
+
+def _encode(names, ids) :
+    # integer codes of names, numbered in order of first appearance across calls
+    import pandas as pd
+    codes, uniques = pd.factorize(names)
+    for name in uniques :
+        if name not in ids :
+            ids[name] = len(ids)
+    return np.array([ ids[name] for name in uniques ], dtype=np.int64)[codes], codes, uniques
+
+
+def read_header(fin) :
+    # sequence lengths and missing regions in the leading ## lines; the column header after them is skipped
     sequences, missing = [], []
+    for line in fin :
+        if line.startswith('##') :
+            if line.startswith('## Sequence_length:') :
+                part = line[2:].strip().split()
+                sequences.append([part[1], int(part[2])])
+            elif line.startswith('## Missing_region:') :
+                part = line[2:].strip().split()
+                missing.append([part[1], int(part[2]), int(part[3])])
+        else :
+            break
+    return sequences, missing
+
+
+def read_data_file(data_file, chunksize=1000000) :
+    import pandas as pd
     with gzip.open(data_file, 'rt') as fin :
-        for line in fin :
-            if line.startswith('##') :
-                if line.startswith('## Sequence_length:') :
-                    part = line[2:].strip().split()
-                    sequences.append([part[1], int(part[2])])
-                elif line.startswith('## Missing_region:') :
-                    part = line[2:].strip().split()
-                    missing.append([part[1], int(part[2]), int(part[3])])
-            else :
-                break
-        data = pd.read_csv(fin, sep='\t', dtype=str, header=None).values
+        sequences, missing = read_header(fin)
+        return parse_mutations(sequences, missing, pd.read_csv(fin, sep='\t', header=None, usecols=range(5), dtype={0:str, 1:str, 2:np.int64, 3:np.int64, 4:str}, chunksize=chunksize))
+
+
+def parse_mutations(sequences, missing, chunks) :
+    # chunks are DataFrames of the mutation table
     branches, mutations = {}, []
     seqLens = {seqName:[seqId, seqLen] for seqId, (seqName, seqLen) in enumerate(sequences)}
-    for d in data :
-        if re.findall(r'^[ACGTacgt]->[ACGTacgt]$', d[4]) :
-            if d[1] not in seqLens :
-                seqLens[d[1]] = [len(seqLens), int(d[2])]
-            if seqLens[d[1]][1] < int(d[2]) :
-                seqLens[d[1]][1] = int(d[2])
-            if d[0] not in branches :
-                branches[d[0]] = len(branches)
-            brId, seqId = branches[d[0]], seqLens[d[1]][0]
-            mutations.append([brId, seqId, int(d[2]), int(d[3])])
+    seqIds = { seqName:seqId for seqName, (seqId, seqLen) in seqLens.items() }
+    for data in chunks :
+        data = data[data[4].str.match(r'^[ACGTacgt]->[ACGTacgt]$', na=False)]
+        if data.shape[0] == 0 :
+            continue
+        sites = data[2].values
+        seqId, codes, uniques = _encode(data[1].values, seqIds)
+        seqMax = np.zeros(uniques.size, dtype=np.int64)
+        np.maximum.at(seqMax, codes, sites)
+        for name, site in zip(uniques, seqMax) :
+            seqLens[name] = [seqIds[name], max(seqLens.get(name, [0, 0])[1], int(site))]
+        brId = _encode(data[0].values, branches)[0]
+        mutations.append(np.vstack([brId, seqId, sites, data[3].values]).T)
     missing = np.array([ [seqLens.get(m[0], [-1])[0], m[1], m[2]] for m in missing ])
     sequences = [ [n, i[1]] for n, i in sorted(seqLens.items(), key=lambda x:x[1][0])]
     branches = np.array([ br for br, id in sorted(branches.items(), key=lambda x:x[1]) ])
-    mutations = np.array(mutations)
+    mutations = np.vstack(mutations)
     reorder = np.argsort(-np.bincount(mutations.T[0]))
     branches = branches[reorder]
     reorder = np.array([i1 for i1, i2 in sorted(enumerate(reorder), key=lambda x:x[1])])
@@ -840,27 +1612,30 @@ def read_data_file(data_file) :
 
 def RecHMM(args) :
     args = parse_arg(args)
-    global pool, verbose
-    pool = Pool(args.n_proc)
+    global verbose
     verbose = not args.clean
 
-    model = recHMM(prefix=args.prefix, mode=args.task)
+    model = recHMM(prefix=args.prefix, mode=args.task, n_proc=args.n_proc, cache=None if args.no_cache else (args.cache or os.path.dirname(os.path.abspath(args.prefix))), model_format='json' if args.json else 'npz')
     
-    if not args.report or not args.model :
+    if not args.report or not args.model or args.update :
         mutations, branches, sequences, missing = read_data_file(args.data)
     if args.model :
-        model.load(open(args.model, 'r'))
-    else :
+        model.load(args.model)
+    if args.update :
+        model.update(mutations, branches=branches, sequences=sequences, missing=missing, categories=args.categories, cool_down=args.cool_down, accelerate=args.accelerate)
+        model.save(model.model_file)
+        print('Best HMM model is saved in {0}'.format(model.model_file))
+    elif not args.model :
         #pass
-        model.fit(mutations, branches=branches, sequences=sequences, missing=missing, categories=args.categories, init=args.init, cool_down=args.cool_down)
-        model.save(open(args.prefix + '.best.model.json', 'w'))
-        print('Best HMM model is saved in {0}'.format(args.prefix + '.best.model.json'))
+        model.fit(mutations, branches=branches, sequences=sequences, missing=missing, categories=args.categories, init=args.init, cool_down=args.cool_down, resume=args.resume, accelerate=args.accelerate)
+        model.save(model.model_file)
+        print('Best HMM model is saved in {0}'.format(model.model_file))
     model.report(args.bootstrap)
 
     if not args.report :
         model.predict(mutations, branches=branches, sequences=sequences, missing=missing, marginal=args.marginal, tree=args.tree)
 
-pool, verbose = None, True
+verbose = True
 if __name__ == '__main__' :
     RecHMM(sys.argv[1:])
 
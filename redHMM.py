@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import numpy as np, pandas as pd, sys, os, argparse, gzip
+from multiprocessing import Pool
+import RecHMM, DivHMM
+
+
+def parse_arg(a) :
+    parser = argparse.ArgumentParser(description='RecHMM followed by DivHMM on the same data, in one run. ', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--data', '-d', help='A list of mutations generated by EToKi phylo', required=True)
+    parser.add_argument('--prefix', '-p', help='Prefix for all the outputs ', default='redHMM')
+    parser.add_argument('--rec_task', help='task to run in RecHMM. \n0: One rec category from external sources.\n1: Three rec categories considering internal, external and mixed sources [default].', default=1, type=int)
+    parser.add_argument('--div_task', help='task to run in DivHMM. \n0: One mut category.\n1: Three mut categories including mixed sources [default].', default=1, type=int)
+    parser.add_argument('--rec_init', help='Initiate RecHMM models with guesses of recombinant proportions. \nDefault: 0.05,0.5,0.95', default='0.05,0.5,0.95')
+    parser.add_argument('--div_init', help='Initiate DivHMM models with guesses of proportions of divergent regions. \nDefault: 0.01,0.05,0.1', default='0.01,0.05,0.1')
+    parser.add_argument('--cool_down', '-c', help='Delete the worst model every N iteration. Default:5', type=int, default=5)
+    parser.add_argument('--n_proc', '-n', help='Number of processes, shared by both models. Default: 5. ', type=int, default=5)
+    parser.add_argument('--bootstrap', '-b', help='Number of Randomizations for confidence intervals. \nDefault: 1000. ', type=int, default=1000)
+    parser.add_argument('--marginal', '-M', help='Find regions using marginal likelihood rather than [DEFAULT] maximum likelihood method. \n[DEFAULT] 0 to use Viterbi algorithm to find most likely path.\n Otherwise (0, 1) use forward-backward algorithm, and report regions with >= M posterior likelihoods.', default=0, type=float)
+    parser.add_argument('--tree', '-T', help='[INPUT, OPTIONAL] A labelled tree. Only used to generate corresponding mutational tree.', default=None)
+    parser.add_argument('--clean', '-v', help='Do not show intermediate results during the iterations.', default=False, action='store_true')
+    parser.add_argument('--accelerate', '-a', help='Extrapolate the global parameters every few EM iterations (SQUAREM). Steps that reduce the likelihood fall back to the plain EM update.', default=False, action='store_true')
+    parser.add_argument('--cache', '-C', help='Folder that keeps the prepared observations, which later runs on the same data map directly. Default: the folder of --prefix. ', default=None)
+    parser.add_argument('--no_cache', help='Do not keep the prepared observations. ', default=False, action='store_true')
+    parser.add_argument('--json', '-J', help='Save the models as JSON rather than in the binary format (.npz). ', default=False, action='store_true')
+    parser.add_argument('--local_r', '-lr', help='Specify a comma-delimited list of branches that share a different R/theta (Frequency of rec) ratio than the global consensus. Can be specified multiple times. \nUse "*" to assign different value for each branch.', default=[], action="append")
+    parser.add_argument('--local_nu', '-ln', help='Specify a comma-delimited list of branches that share a different Nu (SNP density in rec) than the global consensus. Can be specified multiple times. \nUse "*" to assign different value for each branch.', default=[], action="append")
+    parser.add_argument('--local_delta', '-ld', help='Specify a comma-delimited list of branches that share a different Delta (Length of rec sketches) than the global consensus. Can be specified multiple times. \nUse "*" to assign different value for each branch.', default=[], action="append")
+
+    args = parser.parse_args(a)
+    args.categories = RecHMM.parse_categories(args.local_r, args.local_nu, args.local_delta)
+    return args
+
+
+def redHMM(args) :
+    args = parse_arg(args)
+    RecHMM.verbose = DivHMM.verbose = not args.clean
+    cache = None if args.no_cache else (args.cache or os.path.dirname(os.path.abspath(args.prefix)))
+    model_format = 'json' if args.json else 'npz'
+
+    # the table is parsed once; both models take their mutations from the same chunks
+    with gzip.open(args.data, 'rt') as fin :
+        sequences, missing = RecHMM.read_header(fin)
+        chunks = list(pd.read_csv(fin, sep='\t', header=None, usecols=range(5), dtype={0:str, 1:str, 2:np.int64, 3:np.int64, 4:str}, chunksize=1000000))
+
+    pool = Pool(args.n_proc)
+    try :
+        mutations, branches, seqs, ms = RecHMM.parse_mutations(sequences, missing, chunks)
+        model = RecHMM.recHMM(prefix=args.prefix, mode=args.rec_task, n_proc=args.n_proc, cache=cache, pool=pool, model_format=model_format)
+        model.fit(mutations, branches=branches, sequences=seqs, missing=ms, categories=args.categories, init=args.rec_init, cool_down=args.cool_down, accelerate=args.accelerate)
+        model.save(model.model_file)
+        print('Best HMM model is saved in {0}'.format(model.model_file))
+        model.report(args.bootstrap)
+        importations = model.predict(mutations, branches=branches, sequences=seqs, missing=ms, marginal=args.marginal, tree=args.tree)
+
+        # sites in the imported regions of each branch are masked as DivHMM does with --rechmm
+        mutations, seqs, ms = DivHMM.parse_mutations(sequences, missing, chunks, importations)
+        del chunks
+        model = DivHMM.divHMM(prefix=args.prefix, mode=args.div_task, n_proc=args.n_proc, cache=cache, pool=pool, model_format=model_format)
+        model.fit(mutations, sequences=seqs, missing=ms, categories={ 'R/theta':{}, 'nu':{}, 'delta':{} }, init=args.div_init, cool_down=args.cool_down, accelerate=args.accelerate)
+        model.save(model.model_file)
+        print('Best HMM model is saved in {0}'.format(model.model_file))
+        model.report(args.bootstrap)
+        model.predict(mutations, sequences=seqs, missing=ms, marginal=args.marginal)
+    finally :
+        pool.terminate()
+
+
+if __name__ == '__main__' :
+    redHMM(sys.argv[1:])